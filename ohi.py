@@ -43,6 +43,18 @@
 
 infile = None # None = standard input, or set a "filename"
 outdir = "." # current directory by default
+profiles = None # or e.g. {"phone":{"max_filesize":64*1024},
+# "tablet":{"max_filesize":256*1024}} to write several
+# indices, one per directory, from a single read and sort:
+# each profile can set max_filesize, incremental,
+# precompress, max_compressed_filesize, external_js,
+# front_coding, full_text_search and hashed_names (the rest of the settings apply to all).
+# Profiles are written in parallel processes if possible.
+collection = None # or a list of input filenames to merge
+# into one index: each is sorted into a file in a
+# "-sorted" directory next to outdir, which is reused
+# until that input (or the sort settings) change, so
+# rebuilding after editing one input re-sorts only that one
 alphabet = "abcdefghijklmnopqrstuvwxyz" # set to None for all characters and case-sensitive
 ignore_text_in_parentheses = True # or False, for parentheses in index headings
 more_sensible_punctuation_sort_order = True
@@ -53,6 +65,73 @@ remove_utf8_diacritics = True # or False, for removing diacritics in index headi
 max_filesize = 64*1024 # of each HTML file
 # (max_filesize can be exceeded by 1 very large entry)
 
+sort_memory_budget = None # or e.g. 512*1024*1024 to sort
+# input that's too big for RAM: runs of about that many
+# bytes are sorted in memory and spilled to temporary files,
+# which are then merged (and entries are kept in a temporary
+# file until they're written out, so only their index
+# headings need to fit in memory).  Output is the same.
+
+incremental = False # if True, a manifest of pages and
+# their content hashes is kept in outdir, and the next run
+# tries to keep the same page boundaries and file names,
+# writing only the pages whose contents changed (and
+# removing pages that are no longer needed), so that
+# syncing the output after a small edit moves few files.
+# If a page has to be added, it gets a new number, so
+# page numbers are then no longer in order.
+
+precompress = False # if True, a .gz copy of each file is
+# written next to it (for nginx's gzip_static etc), and a
+# .br copy as well if Python's brotli module is installed.
+# Compression runs in background threads where available.
+
+max_compressed_filesize = None # or e.g. 16*1024 to limit
+# the .gz size of each page as well as max_filesize
+# (this needs trial compression so is slower)
+
+zero_copy = False # if True, the input is memory-mapped (if
+# it's not a file, it's first copied to a temporary file)
+# and entries are kept as offsets into it instead of as
+# strings, so memory use follows the size of the index
+# headings rather than the size of the input (the input
+# is then assumed to be UTF-8; sort_memory_budget is not
+# used, as only the headings are sorted in memory)
+
+ingest_processes = 1 # or e.g. 4 (or 0 for the number of
+# CPUs) to find the zero_copy entries' sort keys in that
+# many processes, each taking a part of the input split at
+# an anchor (needs the platform to be able to fork)
+
+external_js = False # if True, the Javascript functions
+# used by every page are written once to ohi.js, which the
+# pages load (and browsers can cache), leaving more of each
+# page's max_filesize for entries
+
+full_text_search = False # if True, also write search.html,
+# which searches the text of the entries (not just their
+# headings) using an inverted index of its words (and of
+# CJK characters and pairs of them) split into s0.js, s1.js
+# etc by word, each within max_filesize, so a search loads
+# only the one or two of them that have its words
+
+front_coding = False # if True, each page's array of
+# headings is front-coded (each heading stored as a digit
+# saying how many characters it shares with the one before
+# it, followed by the rest of it), which is smaller so more
+# entries fit on a page; the page's script decodes only as
+# far as its binary search needs
+
+hashed_names = False # if True, pages are named after a hash
+# of their content (e.g. 3f2a9c01b7e4.html instead of
+# 0.html), so a server can let browsers and proxies cache
+# them indefinitely: a rebuild that leaves a page's entries
+# the same leaves its name the same.  Next/previous links
+# then go via index.html to the first (or last) entry of the
+# page either side, not its name, so the hash can cover the
+# whole page; old pages are not removed unless incremental
+# is set, so links in cached copies still work.
+
 # Where to find history:
 # on GitHub at https://github.com/ssb22/indexer
 # and on GitLab at https://gitlab.com/ssb22/indexer
@@ -62,46 +141,780 @@ max_filesize = 64*1024 # of each HTML file
 
 # ---------------------------------------------------------------
 
-import re,sys,os
-if type("")==type(u""): izip = zip # Python 3
+import re,sys,os,heapq,marshal,tempfile,unicodedata,bisect,hashlib,json,gzip,io,copy,struct,mmap,array
+if type("")==type(u""): izip,xrange,unichr = zip,range,chr # Python 3
 else: from itertools import izip # Python 2
+try: import brotli
+except ImportError: brotli = None
+try: from concurrent.futures import ThreadPoolExecutor # Python 3 (or Python 2 with 'futures' backport)
+except ImportError: ThreadPoolExecutor = None
+
+profileNames = ['max_filesize','incremental','precompress','max_compressed_filesize','external_js','front_coding','full_text_search','hashed_names'] # can differ between profiles
+configNames = ['alphabet','ignore_text_in_parentheses','more_sensible_punctuation_sort_order','remove_utf8_diacritics','max_filesize','sort_memory_budget','zero_copy','ingest_processes','incremental','precompress','max_compressed_filesize','external_js','front_coding','full_text_search','hashed_names']
+
+def build_index(source=None,outdir=".",**config):
+    """Builds the offline index of 'source' into 'outdir'.
+    source can be a filename, a file-like object, or None
+    for standard input.  Keyword arguments override the
+    Configuration variables at the top of this file, e.g.
+    build_index("dict.html","out",max_filesize=256*1024)
+    so a long-running process can build many indices
+    without re-importing this module.
+    Returns (written,removed): lists of the files in
+    outdir that were written and deleted."""
+    B = Build(config)
+    B.read(source) ; B.minimise() ; B.write(outdir)
+    return B.written,B.removed
+
+def build_collection(sources,outdir=".",store_dir=None,**config):
+    """Builds one offline index of several input files
+    (a merged collection), as build_index would for
+    their entries all in one file, with the header and
+    footer of the first.  Each input's entries are
+    sorted into a store in store_dir (default: outdir
+    with "-sorted" added), which later runs reuse if the
+    input hasn't changed, and the stores are merged.
+    Returns (written,removed) like build_index."""
+    if store_dir is None: store_dir = os.path.abspath(outdir)+"-sorted"
+    B = Build(config)
+    B.readCollection(sources,store_dir) ; B.minimise() ; B.write(outdir)
+    return B.written,B.removed
+
+def build_profiles(source=None,profiles={},**config):
+    """Builds an offline index of 'source' into each
+    directory in 'profiles', reading, sorting and
+    minimising prefixes only once.  'profiles' maps
+    each output directory to a dictionary of the
+    settings in profileNames for that directory, e.g.
+    build_profiles("dict.html",{"phone":{"max_filesize":64*1024},"desktop":{"max_filesize":sys.maxsize}})
+    and other keyword arguments apply to all of them.
+    Profiles are segmented and written in parallel by
+    forked worker processes where the platform allows.
+    Returns a dictionary of outdir: (written,removed)."""
+    for outdir,settings in profiles.items():
+        for k in settings:
+            if not k in profileNames: raise TypeError("build_profiles() profile '%s' can't set '%s' (it must be the same for all profiles)" % (outdir,k))
+    global profileBuild
+    profileBuild = Build(config)
+    profileBuild.profileDefaults = dict((k,getattr(profileBuild,k)) for k in profileNames)
+    if any(s.get("incremental") or s.get("full_text_search") for s in profiles.values()): profileBuild.incremental = True # so minimise() records the full keys
+    profileBuild.read(source) ; profileBuild.minimise()
+    profiles = list(profiles.items()) ; pool = None
+    processes = min(len(profiles),cpu_count())
+    if processes > 1 and (not profileBuild.store or hasattr(os,"pread")): pool = forkingPool(processes)
+    try:
+        if pool: results = pool.map(writeProfile,profiles)
+        else: results = [writeProfile(p) for p in profiles]
+    finally:
+        if pool: pool.close() ; pool.join()
+        profileBuild = None
+    return dict((outdir,r) for (outdir,settings),r in zip(profiles,results))
+def writeProfile(profile):
+    "Writes one of build_profiles' profiles (called in a worker process if possible)"
+    outdir,settings = profile
+    B = copy.copy(profileBuild) # shares the fragments
+    for k in profileNames: setattr(B,k,settings.get(k,B.profileDefaults[k]))
+    B.write(outdir)
+    return B.written,B.removed
+def forkingPool(processes):
+    "Returns a multiprocessing Pool whose workers are forked (so they share our memory), or None if we can't"
+    try: import multiprocessing
+    except ImportError: return None
+    if hasattr(multiprocessing,"get_context"): # Python 3.4+
+        try: return multiprocessing.get_context("fork").Pool(processes)
+        except ValueError: return None
+    elif hasattr(os,"fork"): return multiprocessing.Pool(processes) # Python 2 on Unix
+
+class Build:
+    "The configuration and working data of one build_index() run"
+    def __init__(self,config):
+        for k in config:
+            if not k in configNames: raise TypeError("build_index() got an unexpected keyword argument '%s'" % k)
+        g = globals()
+        for k in configNames: setattr(self,k,config.get(k,g[k]))
+        self.store = self.mapped = None
+        self.alphaOnly,self.alphabet = sortKeyFunction(self.alphabet,self.ignore_text_in_parentheses,self.more_sensible_punctuation_sort_order,self.remove_utf8_diacritics)
+    def read(self,source):
+        if self.zero_copy: return self.readMapped(source)
+        toClose = None
+        if source is None:
+            sys.stderr.write("Reading from "+("standard input" if sys.stdin.isatty() else "pipe")+"... ")
+            source = sys.stdin
+        elif not hasattr(source,"read"):
+            sys.stderr.write("Reading from "+source+"... ")
+            source = toClose = open(source)
+        reader = AnchorReader(source) ; alphaOnly = self.alphaOnly
+        fragments = ((alphaOnly(x),y) for x,y in reader)
+        if self.sort_memory_budget: fragments = ExternalSort(fragments,self.sort_memory_budget)
+        else: fragments = list(fragments)
+        if toClose: toClose.close()
+        assert len(fragments), "Couldn't find 2 or more hash tags (were they formatted correctly?)"
+        self.setHeaderFooter(reader.header,reader.footer)
+        sys.stderr.write("%d entries\n" % len(fragments))
+        if self.sort_memory_budget:
+            self.sorted,self.store = iter(fragments),SpillStore()
+        else: self.sorted,self.store = popSorted(fragments),None
+    def readMapped(self,source):
+        "Like read(), but for zero_copy: the fragments' HTML are (start,end) offsets into self.mapped"
+        self.mapped = MappedInput(source)
+        fragments = self.mapped.keyed(self.alphaOnly,self.ingest_processes or cpu_count())
+        assert len(fragments), "Couldn't find 2 or more hash tags (were they formatted correctly?)"
+        self.setHeaderFooter(self.mapped.header,self.mapped.footer)
+        sys.stderr.write("%d entries\n" % len(fragments))
+        self.sortMapped(fragments)
+        self.sorted,self.store = iter(fragments),None
+    def sortMapped(self,fragments):
+        "Sorts zero_copy fragments in place"
+        fragments.sort(key=lambda p:p[0])
+        i = 0
+        while i < len(fragments): # identical keys are sorted by their HTML, as in read()
+            j = i+1
+            while j < len(fragments) and fragments[j][0]==fragments[i][0]: j += 1
+            if j > i+1: fragments[i:j] = sorted(fragments[i:j],key=lambda p:self.fragmentHTML(p[1]))
+            i = j
+    def setHeaderFooter(self,header,footer):
+        self.header,self.footer = header,footer
+        if not self.header.strip(): self.header="""<html><head><meta name="mobileoptimized" content="0"><meta name="viewport" content="width=device-width"><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body>"""
+        if not self.footer.strip(): self.footer = "</body></html>"
+    def readCollection(self,sources,storeDir):
+        "Like read(), but for several input files, k-way merging their sorted stores (see sortedStore)"
+        if not os.path.isdir(storeDir): os.makedirs(storeDir)
+        merging,count = [],0
+        for source in sources:
+            meta,data = self.sortedStore(source,storeDir)
+            merging.append(readMarshalled(open(data,"rb"))) ; count += meta["count"]
+            if len(merging)==1: self.setHeaderFooter(S(meta["header"]),S(meta["footer"]))
+        assert count, "Couldn't find 2 or more hash tags (were they formatted correctly?)"
+        sys.stderr.write("Merging %d entries from %d files\n" % (count,len(sources)))
+        self.sorted = heapq.merge(*merging) # ties are broken by the HTML as in read(), so the result is the same as sorting everything together
+        if self.sort_memory_budget: self.store = SpillStore()
+        else: self.store = None
+    def sortedStore(self,source,storeDir):
+        """Returns (metadata,data filename) of the store
+        in storeDir of the (key,HTML) pairs of file
+        'source' in sorted order, first (re)making it if
+        the source or sort settings have changed since."""
+        name = storeDir+os.sep+os.path.basename(source)+"-"+hashlib.sha1(B(os.path.abspath(source))).hexdigest()[:8]
+        h = hashlib.sha1() ; f = open(source,"rb")
+        for chunk in iter(lambda:f.read(1<<20),b""): h.update(chunk)
+        f.close()
+        check = {"sha1":h.hexdigest(),"sort":[self.alphabet,self.ignore_text_in_parentheses,self.more_sensible_punctuation_sort_order,self.remove_utf8_diacritics],"python":sys.version_info[0]} # (marshal's strings differ between Python 2 and 3)
+        try:
+            meta = json.load(open(name+".json"))
+            if meta["check"]==json.loads(json.dumps(check)) and os.path.exists(name+".sorted"): return meta,name+".sorted"
+        except (IOError,ValueError,KeyError): pass
+        sys.stderr.write("Sorting "+source+"... ")
+        if os.path.exists(name+".json"): os.remove(name+".json")
+        f = open(source) ; reader = AnchorReader(f) ; alphaOnly = self.alphaOnly
+        fragments = ((alphaOnly(x),y) for x,y in reader)
+        if self.sort_memory_budget: fragments = ExternalSort(fragments,self.sort_memory_budget)
+        else: fragments = popSorted(list(fragments))
+        out = open(name+".sorted","wb") ; count = 0
+        for p in fragments:
+            marshal.dump(p,out) ; count += 1
+        out.close() ; f.close()
+        meta = {"check":check,"count":count,"header":U(reader.header),"footer":U(reader.footer)}
+        json.dump(meta,open(name+".json","w")) # (written last, so an interrupted sort is redone next time)
+        sys.stderr.write("%d entries\n" % count)
+        return meta,name+".sorted"
+    def minimise(self):
+        sys.stderr.write("Minimizing prefixes... ")
+        if self.incremental or self.full_text_search: self.sorted = self.recordKeys(self.sorted)
+        self.fragments = self.minimised(self.sorted)
+        del self.sorted
+        sys.stderr.write("done\n")
+    def minimised(self,fragments):
+        """Returns the list of (prefix,HTML) from sorted
+        fragments, where each HTML is already rendered as it
+        will appear on its page (tag and links rewritten),
+        so segmentation and writing never have to run
+        linkSub over the same fragment again.  (With
+        zero_copy the HTML is offsets, rendered on demand.)"""
+        if self.mapped: return list(minimisePrefixes(fragments,joinSpans))
+        fragments = ((x,linkSub(tag(x)+y)) for x,y in minimisePrefixes(fragments))
+        if not self.store: return list(fragments)
+        fragments = [(x,self.store.add(y)) for x,y in fragments]
+        self.store.f.flush() # before any worker processes are forked
+        return fragments
+    def recordKeys(self,fragments):
+        "Passes through sorted fragments, putting each distinct full sort key in self.fullKeys (so it lines up with the minimised fragments)"
+        self.fullKeys = []
+        for x,y in fragments:
+            if not self.fullKeys or not x==self.fullKeys[-1]: self.fullKeys.append(x)
+            yield x,y
+    def fragmentHTML(self,y):
+        if self.store: return self.store[y]
+        elif self.mapped: return ''.join(self.mapped.text(y[i],y[i+1]) for i in xrange(0,len(y),2))
+        else: return y
+    def rendered(self,x,y):
+        "Returns the rendered HTML of fragment (x,y) (see minimised)"
+        if self.mapped: return linkSub(tag(x)+self.fragmentHTML(y))
+        else: return self.fragmentHTML(y)
+    def htmlDoc(self,start,end,prevName,nextName):
+        "Returns an HTML document containing fragments[start:end].  prevName and nextName are used to generate previous/next page links as appropriate."
+        fragments = self.fragments
+        doc = linkSub(self.header)+js_hashjump((x for x,y in fragments[start:end] if x),self.external_js,self.front_coding)
+        prev,nxt = self.pageLinks(start,end,prevName,nextName)
+        doc += prev+''.join(self.rendered(x,y) for x,y in fragments[start:end])+nxt
+        return doc+linkSub(self.footer) # (nothing else needs linkSub: hashtags can't contain '<', and the page links don't match)
+    def pageLinks(self,start,end,prevName,nextName):
+        "Returns the previous and next page links for fragments[start:end] ('' if none).  With hashed_names they go via index.html to the hashtags either side instead of naming the pages, so they stay the same while the entries do."
+        prev = nxt = ""
+        if self.hashed_names:
+            if start:
+                i = start-1
+                while i and not self.fragments[i][0]: i -= 1
+                prev = hashedPrevLink % (self.unswapped(self.fragments[i][0]),)
+            if end<len(self.fragments): nxt = hashedNextLink % (self.unswapped(self.fragments[end][0]),)
+        else:
+            if start: prev = prevLink % (prevName,)
+            if end<len(self.fragments): nxt = nextLink % (nextName,)
+        return prev,nxt
+    def unswapped(self,key):
+        "Returns sort key 'key' as it would be typed into index.html, i.e. undoing more_sensible_punctuation_sort_order's swap so index.html's doesn't apply it twice (and with %20 for space, which index.html allows for in a hash)"
+        if self.more_sensible_punctuation_sort_order: return key.replace(';','%20').replace(',',';')
+        return key
+    def findEnd(self,start,prevName,nextName):
+        "Given 'start' (an index into 'fragments'), find an 'end' that produces the largest possible htmlDoc less than max_filesize.  prevName and nextName are used to generate previous/next page links as appropriate."
+        eTry = len(self.fragments)-start
+        assert eTry, "must start before the end"
+        pageSize,max_filesize = self.pageSize,self.max_filesize
+        sLen = pageSize(start,start+eTry,prevName,nextName)
+        if sLen > max_filesize:
+            eTry = int(eTry / int(sLen / max_filesize)) # rough start point
+            while eTry > 1 and pageSize(start,start+eTry,prevName,nextName) > max_filesize:
+                eTry = int(eTry/2)
+            if eTry < 1: eTry = 1
+        while eTry < len(self.fragments)-start and pageSize(start,start+eTry,prevName,nextName) < max_filesize: eTry += 1
+        end = start + max(1,eTry-1)
+        if self.max_compressed_filesize: end = self.fitCompressed(start,end,prevName,nextName)
+        return end
+    def fitCompressed(self,start,end,prevName,nextName):
+        "Reduces 'end' until the gzipped htmlDoc is within max_compressed_filesize.  Compressed sizes can't be added up like raw ones, so this compresses candidate pages (binary search)."
+        if end-start==1 or self.compressedFits(start,end,prevName,nextName): return end
+        lo,hi = start+1,end # lo is the answer if nothing fits
+        while hi-lo > 1:
+            mid = int((lo+hi)/2)
+            if self.compressedFits(start,mid,prevName,nextName): lo = mid
+            else: hi = mid
+        return lo
+    def compressedFits(self,start,end,prevName,nextName): return len(gzipped(B(self.htmlDoc(start,end,prevName,nextName)))) <= self.max_compressed_filesize
+    def fits(self,start,end,prevName,nextName):
+        "Checks if fragments[start:end] can go on one page"
+        if end-start==1: return True
+        if self.pageSize(start,end,prevName,nextName) > self.max_filesize: return False
+        return not self.max_compressed_filesize or self.compressedFits(start,end,prevName,nextName)
+    def segment(self,old=None):
+        """Yields (start,end,name) for each page.
+        If 'old' is the manifest of a previous run, page
+        boundaries that are still there are kept if they
+        fit, and pages starting at the same place keep the
+        same name, so unaffected pages come out the same.
+        If hashed_names is set, names come from contentName."""
+        self.pageSize = PageSizer(self)
+        n,prevName = len(self.fragments),None
+        hashed = self.hashed_names and "0"*hashedNameLength # for sizing links to pages not yet named
+        if old:
+            oldNames,boundaries = {},[n]
+            keyIndex = dict((k,i) for i,k in enumerate(self.fullKeys))
+            for p in old["pages"]:
+                i = keyIndex.get(S(p["first"]))
+                if i is not None: oldNames[i] = p["name"] ; boundaries.append(i)
+            boundaries.sort()
+            if not hashed: fresh = max(int(p["name"]) for p in old["pages"])+1
+        start = docNo = 0
+        while start < n:
+            if old:
+                name = oldNames.pop(start,None)
+                if name is None and not hashed: name,fresh = str(fresh),fresh+1
+                b = boundaries[bisect.bisect_right(boundaries,start)] # where the old page ended
+                if self.fits(start,b,prevName,hashed or oldNames.get(b,str(fresh))): end = b
+                else:
+                    end = self.findEnd(start,prevName,hashed or str(fresh)) # (a new name has at least as many digits as a reused one)
+                    b = boundaries[bisect.bisect_right(boundaries,end)-1]
+                    if start < b < end and self.fits(start,b,prevName,hashed or oldNames.get(b,str(fresh))): end = b
+            else:
+                name = str(docNo)
+                end = self.findEnd(start,prevName,hashed or str(docNo+1))
+            if hashed: name = self.contentName(start,end)
+            sys.stderr.write("\rSegmenting (%d/%d)" % (end,n))
+            yield start,end,name
+            start,prevName,docNo = end,name,docNo+1
+    def contentName(self,start,end):
+        "Returns a page name for fragments[start:end] from a hash of its htmlDoc (whose links don't name other pages, see pageLinks)"
+        return hashlib.sha1(B(self.htmlDoc(start,end,None,None))).hexdigest()[:hashedNameLength]
+    def write(self,outdir,segments=None):
+        "Writes the pages and index to outdir.  'segments' can be a list of (start,end,name) from an earlier segment() call, which is then not repeated (lets ohi_bench.py time the stages separately)."
+        self.written,self.removed,self.unchanged = [],[],0
+        if self.incremental: old = readManifest(outdir,self.manifestConfig())
+        else: old = None
+        if old: oldPages = dict((p["name"],p) for p in old["pages"])
+        else: oldPages = {}
+        self.manifest = {"config":self.manifestConfig(),"pages":[]}
+        if self.precompress and ThreadPoolExecutor: self.pool,self.compressing = ThreadPoolExecutor(max_workers=max(1,cpu_count()-1)),[]
+        else: self.pool = None
+        sys.stderr.write("Segmenting")
+        pages = []
+        if self.external_js: self.manifest["js"] = self.writeFile(outdir,"ohi.js",self.externalJS(),old and {"sha1":old.get("js")})
+        if segments is None: segments = self.segment(old)
+        for page in segments: # write each page when we know the name of the next one, so writing and compressing can overlap with segmentation
+            if pages: self.writePage(outdir,pages,page[2],oldPages)
+            pages.append(page)
+        self.writePage(outdir,pages,None,oldPages)
+        self.writeIndex(outdir,[self.fragments[start][0] for start,end,name in pages],[name for start,end,name in pages],old)
+        if self.full_text_search: self.writeSearch(outdir,pages,old)
+        if self.pool:
+            for c in self.compressing: c.result() # (re-raises any exception)
+            self.pool.shutdown()
+        nFiles = len(pages)+len(self.manifest["index_pages"])+1+int(self.external_js)+len(self.manifest.get("search_shards",[]))
+        if self.incremental:
+            newNames = set(name for start,end,name in pages)
+            for name in oldPages:
+                if not name in newNames: self.remove(outdir,name)
+            json.dump(self.manifest,open(outdir+os.sep+manifestFile,"w"))
+            sys.stderr.write(" %d files (%d written, %d unchanged, %d removed)\n" % (nFiles,nFiles-self.unchanged,self.unchanged,len(self.removed)))
+        else: sys.stderr.write(" %d files\n" % nFiles)
+    def writePage(self,outdir,pages,nextName,oldPages):
+        "Writes the last page in 'pages'"
+        start,end,name = pages[-1]
+        if len(pages)>1: prevName = pages[-2][2]
+        else: prevName = None
+        p = {"name":name,"count":end-start}
+        if self.incremental: p["first"] = U(self.fullKeys[start])
+        p["sha1"] = self.writeFile(outdir,name+".html",self.htmlDoc(start,end,prevName,nextName),oldPages.get(name),p)
+        self.manifest["pages"].append(p)
+    def writeFile(self,outdir,fName,html,oldEntry,newEntry=None):
+        "Writes html to fName (and compressed copies if precompress is set), unless we're incremental and oldEntry (from the old manifest) says the same content is already there.  Returns the content hash."
+        if self.incremental:
+            h = hashlib.sha1(B(html)).hexdigest()
+            if oldEntry and oldEntry.get("sha1")==h and (newEntry is None or (oldEntry.get("first"),oldEntry.get("count"))==(newEntry["first"],newEntry["count"])) and all(os.path.exists(outdir+os.sep+f) for f in [fName]+self.compressedNames(fName)):
+                self.unchanged += 1 ; return h
+        else: h = None
+        open(outdir+os.sep+fName,"w").write(html)
+        self.written.append(fName)
+        if self.precompress:
+            if self.pool: self.compressing.append(self.pool.submit(writeCompressed,outdir+os.sep+fName,B(html)))
+            else: writeCompressed(outdir+os.sep+fName,B(html))
+            self.written += self.compressedNames(fName)
+        return h
+    def compressedNames(self,fName):
+        if self.precompress: return [fName+ext for ext in compressedExtensions]
+        else: return []
+    def manifestConfig(self):
+        "The settings that, if changed, mean the previous manifest can't be used"
+        return dict((k,getattr(self,k)) for k in configNames if not k in ['sort_memory_budget','zero_copy','ingest_processes','incremental','precompress'])
+    def js_alphabet(self):
+        if self.external_js: return "val=ohi_a(val);"
+        return self.js_normalise()
+    def js_normalise(self):
+        "Javascript to change 'val' as alphaOnly would (goes in index.html, or in ohi.js if external_js)"
+        alphabet = self.alphabet
+        if alphabet:
+            assert not '"' in alphabet and not '\\' in alphabet and not '&' in alphabet and not '<' in alphabet, "Can't use special characters in alphabet (unless js_alphabet is modified to quote them)"
+            js_alphabet = """var a=val.toLowerCase(),i; val="";
+for(i=0; i < a.length; i++) { var c=a.charAt(i); if("%s".indexOf(c)>-1) val += c }
+""" % alphabet # TODO: what if user types letters with diacritics, when remove_utf8_diacritics is set?
+        else: js_alphabet = ""
+        if self.more_sensible_punctuation_sort_order: js_alphabet = "val = val.replace(/-/g,' ').replace(/,/g,'~COM~').replace(/;/g,',').replace(/~COM~/g,';').replace(/ /g,';').replace(/([;,]);+/g,'$1');" + js_alphabet
+        return js_alphabet
+    def writeIndex(self,outdir,keys,names,old):
+        """Writes index.html to look up 'keys' (the first
+        key of each page in 'names').  If that would make
+        index.html bigger than max_filesize, writes
+        intermediate index pages i0.html, i1.html etc, each
+        of which covers a range of pages (or of other
+        intermediate pages), and index.html looks up those
+        instead, so no file is too big however many pages."""
+        if old: oldIndexPages = old.get("index_pages",{})
+        else: oldIndexPages = {}
+        indexPages = self.manifest["index_pages"] = {}
+        while len(keys) > 1 and byteLen(self.indexHTML(keys,names)) > self.max_filesize:
+            newKeys,newNames = [],[]
+            for start,end in self.indexGroups(keys,names):
+                name = "i%d" % len(indexPages)
+                indexPages[name] = self.writeFile(outdir,name+".html",intermediateIndexPage(js_lookup(keys[start:end],names[start:end],"val",self.external_js),self.external_js),{"sha1":oldIndexPages.get(name)})
+                newKeys.append(keys[start]) ; newNames.append(name)
+            keys,names = newKeys,newNames
+        self.manifest["index"] = self.writeFile(outdir,"index.html",self.indexHTML(keys,names),old and {"sha1":old.get("index")})
+        if self.incremental:
+            for name in oldIndexPages:
+                if not name in indexPages: self.remove(outdir,name)
+    def indexGroups(self,keys,names):
+        "Splits keys into (start,end) ranges that each fit in an intermediate index page of max_filesize (at least 2 per page so the number of keys goes down)"
+        perPage = self.max_filesize - byteLen(intermediateIndexPage(js_lookup([],[],"val",self.external_js),self.external_js))
+        start,size = 0,0
+        for i in xrange(len(keys)):
+            s = byteLen(keys[i])+byteLen(names[i])+2 # (with separators)
+            if size+s > perPage and i-start >= 2:
+                yield start,i
+                start,size = i,0
+            size += s
+        yield start,len(keys)
+    def remove(self,outdir,name,ext=".html"):
+        "Removes name.html (or other 'ext') and its compressed copies, if present"
+        for f in [name+ext]+[name+ext+c for c in compressedExtensions]:
+            if os.path.exists(outdir+os.sep+f):
+                os.remove(outdir+os.sep+f) ; self.removed.append(f)
+    def indexHTML(self,keys,names):
+        return """%s<script><!--
+function jump() {
+  var val=document.forms[0].q.value; %s
+  location.href=%s+".html#"+val
+}
+if(navigator.userAgent.indexOf("Opera/9.50" /* sometimes found on WM6.1 phones from 2008 */) >= 0) document.write("<p><b>WARNING:</"+"b> Your version of Opera may have trouble jumping to anchors; please try Opera 10 or above.</"+"p>")
+//-->
+</script><noscript><p><b>ERROR:</b> Javascript needs to be switched on for this form to work.</p></noscript>
+<form action="#" onSubmit="jump();return false">Lookup: <input type="text" name="q"><input type="submit" value="ok">%s</form><script><!--
+if(location.hash.length > 1) { document.forms[0].q.value = location.hash.slice(1).replace(/(\+|%%20)/g,' '); jump(); } else document.forms[0].q.focus();
+//-->
+</script>%s""" % (hashReload(linkSub(self.header))+externalScript(self.external_js),self.js_alphabet(),js_lookup(keys,names,"val",self.external_js),[""," <a href=\"search.html\">Search text</a>"][self.full_text_search],hashReload(linkSub(self.footer)))
+    def writeSearch(self,outdir,pages,old):
+        """Writes search.html and its shards s0.js, s1.js
+        etc.  Each shard calls ohi_s() with an object
+        mapping words to lists of "page#key" for the
+        entries containing them (where key is the entry's
+        full sort key, so the page's script finds it), and
+        search.html has the first word of each shard so it
+        can load the ones it needs.  A word with too many
+        entries for one shard continues in the next."""
+        sys.stderr.write(" indexing text...")
+        postings,self.searchTargets = {},[]
+        for start,end,name in pages:
+            for i in xrange(start,end):
+                self.searchTargets.append(json.dumps(U(name+"#"+self.fullKeys[i]),ensure_ascii=False))
+                for w in searchWords(self.rendered(*self.fragments[i])): postings.setdefault(w,[]).append(i)
+        perShard = self.max_filesize - byteLen(searchShard([]))
+        shards,keys,shard,size = [],[],[],0
+        for w in sorted(postings):
+            targets = [self.searchTargets[i] for i in postings[w]]
+            del postings[w]
+            prefix = json.dumps(U(w),ensure_ascii=False)+":["
+            while targets:
+                room,n,used = perShard-size-byteLen(prefix)-2,0,0
+                while n < len(targets) and used+byteLen(targets[n])+1 <= room:
+                    used += byteLen(targets[n])+1 ; n += 1
+                if not n:
+                    if shard: # try again in a new shard
+                        shards.append(shard) ; shard,size = [],0 ; continue
+                    n = 1 # (too big even for an empty shard)
+                if not shard: keys.append(w)
+                entry = prefix+",".join(targets[:n])+"]"
+                shard.append(entry) ; size += byteLen(entry)+1
+                targets = targets[n:]
+                if targets: shards.append(shard) ; shard,size = [],0
+        if shard: shards.append(shard)
+        del self.searchTargets
+        if old: oldShards = old.get("search_shards",{})
+        else: oldShards = {}
+        newShards = self.manifest["search_shards"] = {}
+        for i,shard in enumerate(shards): newShards["s%d" % i] = self.writeFile(outdir,"s%d.js" % i,searchShard(shard),{"sha1":oldShards.get("s%d" % i)})
+        self.manifest["search"] = self.writeFile(outdir,"search.html",self.searchHTML(keys),old and {"sha1":old.get("search")})
+        if self.incremental:
+            for name in oldShards:
+                if not name in newShards: self.remove(outdir,name,".js")
+    def searchHTML(self,keys):
+        return """%s<script><!--
+var K=%s, R, want, words;
+function ohi_s(d) { for(var w in d) R[w]=(R[w]||[]).concat(d[w]); if(!--want) show() }
+function search() {
+  var q=document.forms[0].q.value.toLowerCase(), m, need={}, i, s;
+  if(q.normalize) q=q.normalize("NFD").replace(/[%s]/g,"");
+  var re=/([%s]+)|([^%s%s]{2,})/g; words=[];
+  while((m=re.exec(q))) { if(m[2]) words.push(m[2]); else if(m[1].length==1) words.push(m[1]); else for(i=0;i+1<m[1].length;i++) words.push(m[1].slice(i,i+2)) }
+  for(s=0; s<words.length; s++) for(i=0; i<K.length; i++) if(K[i]<=words[s] && (i+1==K.length || K[i+1]>=words[s])) need[i]=1;
+  R={}; want=1; for(i in need) { want++; var e=document.createElement("script"); e.src="s"+i+".js"; document.body.appendChild(e) }
+  if(!--want) show()
+}
+function show() {
+  var r=words.length ? R[words[0]]||[] : [], i, j, h="";
+  for(i=1; i<words.length; i++) { var o={}, a=R[words[i]]||[], r2=[]; for(j=0;j<a.length;j++) o[a[j]]=1; for(j=0;j<r.length;j++) if(o[r[j]]) r2.push(r[j]); r=r2 }
+  for(i=0; i<r.length && i<200; i++) { j=r[i].indexOf("#"); h+='<li><a href="'+r[i].slice(0,j)+'.html'+r[i].slice(j)+'">'+r[i].slice(j+1)+'</a></li>' }
+  document.getElementById("r").innerHTML = "<p>"+r.length+" found</p>"+(r.length ? "<ol>"+h+"</ol>" : "")
+}
+//-->
+</script><noscript><p><b>ERROR:</b> Javascript needs to be switched on for this form to work.</p></noscript>
+<form action="#" onSubmit="search();return false">Search text: <input type="text" name="q"><input type="submit" value="ok"> <a href="index.html">Lookup</a></form><div id="r"></div><script><!--
+document.forms[0].q.focus();
+//-->
+</script>%s""" % (linkSub(self.header),old_javascript_array(keys),charClass(searchMarks,True),charClass(searchCJK,True),charClass(searchSeparators,True),charClass(searchCJK,True),linkSub(self.footer))
+    def externalJS(self):
+        "Returns the contents of ohi.js for external_js"
+        return """var ohi_b=%s, ohi_dx=%s;
+function ohi_h(a) { %s }
+function ohi_a(val) { %s
+return val }
+""" % ([js_binchop,js_binchop_fc][self.front_coding],js_binchop_dx,js_hashjump_body % "ohi_b(a,h.slice(1))",self.js_normalise())
+
+# Code point ranges for searchWords and the search.html
+# script, which must split text into words the same way:
+searchCJK = [(0x3400,0x9fff),(0xf900,0xfaff)]
+searchSeparators = [(0,0x2f),(0x3a,0x40),(0x5b,0x60),(0x7b,0xbf),(0xd7,0xd7),(0xf7,0xf7),(0x1680,0x1680),(0x2000,0x206f),(0x3000,0x303f),(0xfe30,0xfe4f),(0xfeff,0xfeff),(0xff01,0xff0f),(0xff1a,0xff20),(0xff3b,0xff40),(0xff5b,0xff65)] # whitespace and punctuation (ASCII, Latin-1, general, CJK and full-width)
+searchMarks = [(0x300,0x36f)] # combining diacritics (removed after NFD)
+def charClass(ranges,js=False):
+    "Returns the inside of a regular expression character class matching 'ranges' of code points, for Python or (if js) Javascript"
+    if js: return "".join("\\u%04x-\\u%04x" % r for r in ranges)
+    return u"".join(re.escape(unichr(a))+u"-"+re.escape(unichr(b)) for a,b in ranges)
+searchTagRe = re.compile(r'<[^>]*>|&#?[0-9A-Za-z]+;')
+searchWordRe = re.compile(u'([%s]+)|([^%s%s]{2,})' % (charClass(searchCJK),charClass(searchSeparators),charClass(searchCJK))) # CJK, or at least 2 of anything else that's not a separator
+searchMarkRe = re.compile(u'[%s]' % charClass(searchMarks))
+def searchWords(html):
+    "Returns the set of words to index in html: lower case, without diacritics, and with runs of CJK characters as single characters and overlapping pairs (what the search.html script looks for)"
+    text = searchMarkRe.sub(u'',unicodedata.normalize('NFD',U(searchTagRe.sub(' ',html)).lower()))
+    words = set()
+    for cjk,other in searchWordRe.findall(text):
+        if other:
+            if len(other) <= 40: words.add(S(other)) # (longer is unlikely to be searched for)
+        else:
+            words.update(S(c) for c in cjk)
+            words.update(S(cjk[i:i+2]) for i in xrange(len(cjk)-1))
+    return words
+def searchShard(entries): return S(u"ohi_s({%s})\n" % u",".join(U(e) for e in entries))
+
+def js_lookup(keys,names,val,external=False):
+    "Returns a Javascript expression for the name of the file in 'names' whose key in 'keys' is the nearest before 'val'"
+    if external: binchop = "ohi_dx" # from ohi.js
+    else: binchop = js_binchop_dx
+    lookup = "%s(%s,%s)" % (binchop,old_javascript_array(keys),val)
+    if names and all(n.isdigit() for n in names) and names==[str(int(names[0])+i) for i in xrange(len(names))]: # consecutive numbers
+        if int(names[0]): return "(%d+%s)" % (int(names[0]),lookup)
+        else: return lookup
+    return "%s[%s]" % (old_javascript_array(names),lookup)
+def intermediateIndexPage(lookup,external=False): return """<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body>%s<script><!--
+var val=location.hash.slice(1); if(val) location.replace(%s+".html#"+val); else location.href="index.html"
+//-->
+</script></body></html>""" % (externalScript(external),lookup)
+def externalScript(external):
+    if external: return '<script src="ohi.js"></script>'
+    else: return ''
+
+def gzipped(data):
+    "Returns data gzipped at the highest level, with no timestamp, so the output depends only on the data"
+    f = io.BytesIO()
+    g = gzip.GzipFile(filename="",mode="wb",compresslevel=9,fileobj=f,mtime=0)
+    g.write(data) ; g.close()
+    return f.getvalue()
+compressedExtensions = [".gz"]
+if brotli: compressedExtensions.append(".br")
+def writeCompressed(fName,data):
+    "Writes the compressed copies of fName's data (called in a background thread if possible: zlib and brotli release the GIL)"
+    open(fName+".gz","wb").write(gzipped(data))
+    if brotli: open(fName+".br","wb").write(brotli.compress(data))
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError,NotImplementedError): return 1
+
+manifestFile = "ohi-manifest.json"
+hashedNameLength = 12 # hex digits of the content hash in page names (for hashed_names)
+def readManifest(outdir,config):
+    "Returns the manifest left in outdir by a previous incremental run with the same config, or None"
+    try: m = json.load(open(outdir+os.sep+manifestFile))
+    except (IOError,ValueError): return None
+    if not (m.get("config")==json.loads(json.dumps(config)) and m.get("pages")): return None
+    for p in m["pages"]: p["name"] = str(p["name"]) # not unicode in Python 2
+    return m
+
+def S(s):
+    if type(u"")==type(""): return s # Python 3
+    else: return s.encode('utf-8') # Python 2
+def U(s):
+    if type(s)==type(u""): return s
+    return s.decode('utf-8')
+parenthesesRe = re.compile(r"\([^)]*\)[;, ]*")
+leadingPunctuationRe = re.compile(r"^[@,;]*")
+repeatedSeparatorRe = re.compile('([;,]);+')
+def composedSortKeyFunction(alphabet,ignore_text_in_parentheses,more_sensible_punctuation_sort_order,remove_utf8_diacritics):
+    "Returns (alphaOnly,alphabet) built up as a stack of simple steps.  This is the reference definition of the sort key; compiledSortKeyFunction must agree with it."
+    def alphaOnly(x):
+      if ignore_text_in_parentheses: x=parenthesesRe.sub("",x)
+      if alphabet: x=''.join(c for c in x.lower() if c in alphabet)
+      return leadingPunctuationRe.sub("",x) # see ohi_latex.py
+    if more_sensible_punctuation_sort_order:
+      _ao1 = alphaOnly
+      alphaOnly = lambda x: _ao1(repeatedSeparatorRe.sub(r'\1',x.replace('-',' ').replace(',','~COM~').replace(';',',').replace('~COM~',';').replace(' ',';'))) # gives ; < , == space (useful if ; is used to separate definitions and , is used before extra words to be added at the start; better set space EQUAL to comma, not higher, or will end up in wrong place if user inputs something forgetting the comma)
+      if alphabet:
+        for c in '@,;':
+          if not c in alphabet: alphabet += c
+    if remove_utf8_diacritics:
+      _ao = alphaOnly
+      alphaOnly = lambda x: _ao(S(u''.join((c for c in unicodedata.normalize('NFD',U(x)) if not unicodedata.category(c).startswith('M')))))
+    return alphaOnly,alphabet
+
+class TranslationCache(dict):
+    "A table for str.translate that works out each code point's replacement (by calling func) the first time it's seen"
+    def __init__(self,func): self.func = func
+    def __missing__(self,c):
+        r = self[c] = self.func(chr(c))
+        return r
+def withoutMarks(c): return u''.join(d for d in unicodedata.normalize('NFD',c) if not unicodedata.category(d).startswith('M'))
+punctuationTable = {ord('-'):';',ord(' '):';',ord(','):';',ord(';'):','}
+try: isASCII = str.isascii # Python 3.7+
+except AttributeError: isASCII = lambda x: False
+
+def compiledSortKeyFunction(reference,alphabet,ignore_text_in_parentheses,more_sensible_punctuation_sort_order,remove_utf8_diacritics):
+    """Returns a Python 3 alphaOnly equivalent to reference (from composedSortKeyFunction, with its extended alphabet) but doing each step in one pass with translate tables.
+    Stripping marks one code point at a time gives the same result as NFD of the whole string because every character with a nonzero combining class is a mark, so canonical reordering can't move anything that survives."""
+    stripMarks = TranslationCache(withoutMarks)
+    if alphabet: keep = TranslationCache(lambda c: c if c in alphabet else None)
+    def alphaOnly(x):
+      if remove_utf8_diacritics and not isASCII(x): x = x.translate(stripMarks)
+      if more_sensible_punctuation_sort_order:
+        if '~' in x: return reference(x) # could clash with ~COM~
+        if ';' in x: x = x.translate(punctuationTable)
+        else: x = x.replace('-',';').replace(' ',';').replace(',',';') # (quicker than translate when nothing needs swapping)
+        if ';;' in x or ',;' in x: x = repeatedSeparatorRe.sub(r'\1',x)
+      if ignore_text_in_parentheses and '(' in x: x = parenthesesRe.sub("",x)
+      if alphabet: x = x.lower().translate(keep)
+      return x.lstrip('@,;')
+    return alphaOnly
+
+_sortKeyFunctions = {}
+def sortKeyFunction(alphabet,ignore_text_in_parentheses,more_sensible_punctuation_sort_order,remove_utf8_diacritics):
+    "Returns (alphaOnly,alphabet) for these settings, where alphabet may have had punctuation added.  Cached, so repeated builds with the same settings reuse them."
+    k = (alphabet,ignore_text_in_parentheses,more_sensible_punctuation_sort_order,remove_utf8_diacritics)
+    if not k in _sortKeyFunctions:
+      alphaOnly,alphabet = composedSortKeyFunction(*k)
+      if type("")==type(u""): alphaOnly = compiledSortKeyFunction(alphaOnly,alphabet,*k[1:]) # Python 3 (Python 2 strings here are UTF-8 bytes, so keep the composed version)
+      _sortKeyFunctions[k] = (alphaOnly,alphabet)
+    return _sortKeyFunctions[k]
+
+class AnchorReader:
+    "Iterates over (heading,HTML) pairs from file f, reading chunkSize characters at a time instead of the whole file.  Sets .header when the first anchor is found, and .footer (the text after the last anchor) when iteration finishes."
+    anchor = re.compile(r'<a name="([^"]*)"></a>')
+    opener = '<a name="'
+    partial = re.compile(r'<a name="[^"]*(?:"(?:>(?:<(?:/a?)?)?)?)?$')
+    def __init__(self,f,chunkSize=1024*1024):
+        self.f,self.chunkSize = f,chunkSize
+        self.header = self.footer = None
+    def __iter__(self):
+        buf,tag,text = "",None,[]
+        while True:
+            chunk = self.f.read(self.chunkSize)
+            buf += chunk ; pos = 0
+            for m in self.anchor.finditer(buf):
+                text.append(buf[pos:m.start()])
+                if tag is None: self.header = ''.join(text)
+                else: yield tag,''.join(text)
+                tag,text,pos = m.group(1),[],m.end()
+            if not chunk: break
+            keep = self.incompleteAnchor(buf,pos)
+            text.append(buf[pos:keep]) ; buf = buf[keep:]
+        text.append(buf[pos:])
+        if tag is None: self.header = ''
+        self.footer = ''.join(text)
+    def incompleteAnchor(self,buf,pos):
+        "Returns where an anchor that might be completed by the next chunk starts in buf[pos:] (or len(buf) if there isn't one)"
+        i = buf.rfind(self.opener,pos)
+        if i > -1 and self.partial.match(buf,i): return i
+        for l in xrange(len(self.opener)-1,0,-1):
+            if len(buf)-l >= pos and buf.endswith(self.opener[:l]): return len(buf)-l
+        return len(buf)
+
+class MappedInput:
+    "Memory-maps the input (copying it to a temporary file first if it's not a file we can open), and iterates over (heading,(start,end)) for each entry, setting .header and .footer as AnchorReader does"
+    anchor = re.compile(b'<a name="([^"]*)"></a>')
+    def __init__(self,source):
+        if source is None:
+            sys.stderr.write("Reading from "+("standard input" if sys.stdin.isatty() else "pipe")+"... ")
+            source = getattr(sys.stdin,"buffer",sys.stdin) # (bytes in Python 3)
+        elif not hasattr(source,"read"): sys.stderr.write("Reading from "+source+"... ")
+        if hasattr(source,"read"):
+            self.f = tempfile.TemporaryFile()
+            for chunk in iter(lambda:source.read(1024*1024),source.read(0)): self.f.write(B(chunk))
+            self.f.flush()
+        else: self.f = open(source,"rb")
+        self.m = mmap.mmap(self.f.fileno(),0,access=mmap.ACCESS_READ)
+    def __iter__(self):
+        heading,pos = None,0
+        for m in self.anchor.finditer(self.m):
+            if heading is None: self.header = self.text(0,m.start())
+            else: yield S(heading.decode('utf-8')),(pos,m.start())
+            heading,pos = m.group(1),m.end()
+        if heading is None: self.header,pos = "",0
+        self.footer = self.text(pos,len(self.m))
+    def keyed(self,alphaOnly,processes=1):
+        """Returns a list of (alphaOnly(heading),(start,end))
+        for each entry, setting .header and .footer.  If
+        'processes' is more than 1, the input is split at
+        anchors into several chunks per process, and a
+        pool of forked workers finds their keys."""
+        global ingesting
+        first,pool = self.anchor.search(self.m),None
+        if first and processes > 1:
+            ingesting = self,alphaOnly # (before forking)
+            pool = forkingPool(processes)
+        if not pool:
+            ingesting = None
+            return [(alphaOnly(x),y) for x,y in self]
+        size,n = len(self.m),processes*4
+        points = [first.start()]
+        for i in xrange(1,n):
+            m = self.anchor.search(self.m,max(points[-1]+1,first.start()+int((size-first.start())*i/n)))
+            if not m: break
+            points.append(m.start())
+        points.append(size)
+        try: chunks = pool.map(keyChunk,list(zip(points,points[1:])))
+        finally:
+            pool.close() ; pool.join()
+            ingesting = None
+        keyed = [(k,(o[2*i],o[2*i+1])) for keys,o in chunks for i,k in enumerate(keys)]
+        footer = keyed.pop() # the last anchor's 'entry'
+        self.header,self.footer = self.text(0,points[0]),self.text(footer[1][0],size)
+        return keyed
+    def text(self,start,end):
+        t = self.m[start:end]
+        if type(t)==type(""): return t # Python 2
+        return t.decode('utf-8').replace('\r\n','\n').replace('\r','\n') # as Python 3's open() would
+def keyChunk(bounds):
+    "Returns the keys of the anchors from byte bounds[0] (an anchor) to bounds[1], and an array of the start and end of each entry (which pickles faster than tuples), for MappedInput.keyed (called in a worker process)"
+    mapped,alphaOnly = ingesting
+    keys,offsets = [],array.array('l')
+    for m in mapped.anchor.finditer(mapped.m,bounds[0],bounds[1]):
+        keys.append(alphaOnly(S(m.group(1).decode('utf-8'))))
+        if offsets: offsets.append(m.start())
+        offsets.append(m.end())
+    offsets.append(bounds[1])
+    return keys,offsets
+def joinSpans(spans): return sum(spans,())
+
+class ExternalSort:
+    "Sorts (key,HTML) pairs in runs of about 'budget' bytes, each spilled to a temporary file; iterating merges the runs"
+    def __init__(self,pairs,budget):
+        self.runs,self.count = [],0
+        run,size = [],0
+        for p in pairs:
+            run.append(p) ; size += len(p[0])+len(p[1]) ; self.count += 1
+            if size >= budget:
+                self.spill(run) ; run,size = [],0
+        if run: self.spill(run)
+    def spill(self,run):
+        run.sort() ; f = tempfile.TemporaryFile()
+        for p in run: marshal.dump(p,f)
+        f.seek(0) ; self.runs.append(f)
+    def __len__(self): return self.count
+    def __iter__(self): return heapq.merge(*[readMarshalled(f) for f in self.runs])
+def readMarshalled(f):
+    while True:
+        try: yield marshal.load(f)
+        except EOFError: return
+class SpillStore:
+    "Keeps strings in a temporary file, so only their offsets need to be held in memory.  Reads use os.pread where available, so forked processes can share the file."
+    def __init__(self): self.f = tempfile.TemporaryFile()
+    def add(self,s):
+        self.f.seek(0,2) ; pos = self.f.tell()
+        s = marshal.dumps(s)
+        self.f.write(struct.pack('<I',len(s))+s) ; return pos
+    def __getitem__(self,pos):
+        if hasattr(os,"pread"): # Python 3 on Unix
+            fd = self.f.fileno()
+            return marshal.loads(os.pread(fd,struct.unpack('<I',os.pread(fd,4,pos))[0],pos+4))
+        self.f.seek(pos) ; return marshal.loads(self.f.read(struct.unpack('<I',self.f.read(4))[0]))
+def popSorted(l):
+    "Sorts l and yields its items in order, emptying it as we go"
+    l.sort() ; l.reverse()
+    while l: yield l.pop()
 
-if infile:
-    sys.stderr.write("Reading from "+infile+"... ")
-    infile = open(infile)
-else:
-    sys.stderr.write("Reading from "+("standard input" if sys.stdin.isatty() else "pipe")+"... ")
-    infile = sys.stdin
-fragments = re.split(r'<a name="([^"]*)"></a>',infile.read())
-# odd indices should be the tag names, even should be the HTML in between
-assert len(fragments)>3, "Couldn't find 2 or more hash tags (were they formatted correctly?)"
-assert len(fragments)%2, "re.split not returning groups??"
-header,footer = fragments[0],fragments[-1]
-if not header.strip(): header="""<html><head><meta name="mobileoptimized" content="0"><meta name="viewport" content="width=device-width"><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body>"""
-if not footer.strip(): footer = "</body></html>"
-fragments = fragments[1:-1]
-sys.stderr.write("%d entries\n" % len(fragments))
-def alphaOnly(x):
-  if ignore_text_in_parentheses: x=re.sub(r"\([^)]*\)[;, ]*","",x)
-  if alphabet: x=''.join(c for c in x.lower() if c in alphabet)
-  return re.sub(r"^[@,;]*","",x) # see ohi_latex.py
-if more_sensible_punctuation_sort_order:
-    _ao1 = alphaOnly
-    alphaOnly = lambda x: _ao1(re.sub('([;,]);+',r'\1',x.replace('-',' ').replace(',','~COM~').replace(';',',').replace('~COM~',';').replace(' ',';'))) # gives ; < , == space (useful if ; is used to separate definitions and , is used before extra words to be added at the start; better set space EQUAL to comma, not higher, or will end up in wrong place if user inputs something forgetting the comma)
-    if alphabet:
-      for c in '@,;':
-        if not c in alphabet: alphabet += c
-if remove_utf8_diacritics:
-    _ao = alphaOnly ; import unicodedata
-    def S(s):
-        if type(u"")==type(""): return s # Python 3
-        else: return s.encode('utf-8') # Python 2
-    def U(s):
-        if type(s)==type(u""): return s
-        return s.decode('utf-8')
-    alphaOnly = lambda x: _ao(S(u''.join((c for c in unicodedata.normalize('NFD',U(x)) if not unicodedata.category(c).startswith('M')))))
-fragments = list(zip(map(alphaOnly,fragments[::2]), fragments[1::2]))
-fragments.sort()
 class ChangedLetters:
     def __init__(self): self.lastText = ""
     def __call__(self,text):
@@ -115,16 +928,16 @@ class ChangedLetters:
                 return text[:i]
         assert text==self.lastText, repr(text)+"!="+repr(self.lastText)
         return "" # no difference from lastText
-changedLetters = ChangedLetters() ; f2 = []
-fragments.reverse()
-sys.stderr.write("Minimizing prefixes... ")
-while fragments:
-    x,y = fragments.pop()
-    x = changedLetters(x)
-    if f2 and not x: f2[-1] = (f2[-1][0], f2[-1][1]+y) # combine effectively-identical ones
-    else: f2.append((x,y))
-sys.stderr.write("done\n")
-fragments = f2
+def minimisePrefixes(fragments,join=''.join):
+    "Yields (shortest distinguishing prefix, HTML) from sorted (key, HTML) pairs, combining effectively-identical ones (using 'join')"
+    changedLetters = ChangedLetters() ; lastX,lastY = None,[]
+    for x,y in fragments:
+        x = changedLetters(x)
+        if lastY and not x: lastY.append(y)
+        else:
+            if lastY: yield lastX,join(lastY)
+            lastX,lastY = x,[y]
+    if lastY: yield lastX,join(lastY)
 def tag(n):
     if n: return '<a name="%s"></a>' % n
     else: return ''
@@ -148,61 +961,88 @@ return inner(a,i,mid,hi);
 } return inner(a,i,0,a.length);
 }"""
 js_binchop_dx = js_binchop.replace("return a[mid]","return mid")
-def js_hashjump(hashtags): return """<script><!--
-var h=location.hash; if(h.length > 1) { if(h!='#_h' && h!='#_f') { var n="#"+%s(%s,h.slice(1)); if (h!=n) location.hash=n; } } else location.href="index.html"
+js_binchop_fc = """function(a,i) {
+var d=[],n=0,p="";
+function get(k) { while(n<=k && n<a.length) { var e=a[n]; p=p.slice(0,e.charCodeAt(0)-48)+e.slice(1); d[n++]=p } return d[k] }
+function inner(lo,hi) {
+var mid=lo+Math.floor((hi-lo)/2);
+if(mid==lo || get(mid)==i) return get(mid);
+if(get(mid) > i) return inner(lo,mid);
+return inner(mid,hi);
+} return inner(0,a.length);
+}""" # as js_binchop but for front-coded a, decoding only as far as needed
+def frontCoded(prev,x):
+    "Returns x front-coded against prev (for js_binchop_fc): a digit for how many characters (in Javascript's UTF-16 terms, up to 9) they share, then the rest of x"
+    prev,x = U(prev),U(x)
+    i = units = 0
+    while i < len(x) and i < len(prev) and x[i]==prev[i]:
+        u = 2 if ord(x[i]) > 0xFFFF else 1 # (surrogate pair)
+        if units+u > 9: break
+        i,units = i+1,units+u
+    return S(str(units)+x[i:])
+def frontCodedArray(hashtags):
+    prev,r = "",[]
+    for x in hashtags:
+        r.append(frontCoded(prev,x)) ; prev = x
+    return r
+js_hashjump_body = """var h=location.hash; if(h.length > 1) { if(h!='#_h' && h!='#_f') { var n="#"+%s; if (h!=n) location.hash=n; } } else location.href="index.html\"""" # (the h!=n test is needed to avoid loop on some  browsers e.g. PocketIE7)
+def js_hashjump(hashtags,external=False,frontCoding=False):
+    if frontCoding: hashtags,binchop = frontCodedArray(hashtags),js_binchop_fc
+    else: binchop = js_binchop
+    if external: return """<script src="ohi.js"></script><script><!--
+ohi_h(%s)
+//-->
+</script>""" % old_javascript_array(hashtags)
+    return """<script><!--
+%s
 //-->
-</script>""" % (js_binchop,old_javascript_array(hashtags)) # (the h!=n test is needed to avoid loop on some  browsers e.g. PocketIE7)
+</script>""" % (js_hashjump_body % ("%s(%s,h.slice(1))" % (binchop,old_javascript_array(hashtags))),)
 # #_h and #_f are special hashes for header and footer, used for "Next page" and "Previous page" links
 # (HTML5 defaults type to text/javascript, as do all pre-HTML5 browsers including NN2's 'script language="javascript"' thing, so we might as well save a few bytes)
 
-__lastStartEnd = None
-def htmlDoc(start,end,docNo):
-    "Returns an HTML document containing fragments[start:end].  docNo is used to generate previous/next page links as appropriate.  Caches its return value in case called again with same start,end (in which case docNo is ignored on second call)."
-    global __lastStartEnd,__lastDoc
-    if not (start,end) == __lastStartEnd:
-        __lastStartEnd = (start,end)
-        __lastDoc = header+js_hashjump(x for x,y in fragments[start:end] if x)
-        if start:
-            assert docNo, "Document 0 should start at 0"
-            __lastDoc += '<p><a name="_h" href="%d.html#_f">Previous page</a></p>' % (docNo-1,)
-        __lastDoc += ''.join(tag(x)+y for x,y in fragments[start:end])
-        if end<len(fragments): __lastDoc += '<p><a name="_f" href="%d.html#_h">Next page</a></p>' % (docNo+1,)
-        __lastDoc += footer
-    return linkSub(__lastDoc)
-
-def linkSub(txt): return re.sub(r'(?i)<a href=("?)#',r'<a href=\1index.html#',txt) # (do link to index.html#whatever rather than directly, so link still works if docs change)
-
-def findEnd(start,docNo):
-    "Given 'start' (an index into 'fragments'), find an 'end' that produces the largest possible htmlDoc less than max_filesize.  docNo is used to generate previous/next page links as appropriate."
-    eTry = len(fragments)-start
-    assert eTry, "must start before the end"
-    sLen = len(htmlDoc(start,start+eTry,docNo))
-    if sLen > max_filesize:
-        eTry = int(eTry / int(sLen / max_filesize)) # rough start point
-        while eTry > 1 and len(htmlDoc(start,start+eTry,docNo)) > max_filesize:
-            eTry = int(eTry/2)
-        if eTry < 1: eTry = 1
-    while eTry < len(fragments)-start and len(htmlDoc(start,start+eTry,docNo)) < max_filesize: eTry += 1
-    return start + max(1,eTry-1)
-def allRanges():
-    start = docNo = 0
-    while start < len(fragments):
-        end = findEnd(start,docNo)
-        sys.stderr.write("\rSegmenting (%d/%d)" % (end,len(fragments)))
-        yield start,end
-        start = end ; docNo += 1
-sys.stderr.write("Segmenting")
-startsList = []
-for start,end in allRanges():
-    open(("%s%s%d.html" % (outdir,os.sep,len(startsList))),"w").write(htmlDoc(start,end,len(startsList)))
-    startsList.append(start)
-if alphabet:
-    assert not '"' in alphabet and not '\\' in alphabet and not '&' in alphabet and not '<' in alphabet, "Can't use special characters in alphabet (unless js_alphabet is modified to quote them)"
-    js_alphabet = """var a=val.toLowerCase(),i; val="";
-for(i=0; i < a.length; i++) { var c=a.charAt(i); if("%s".indexOf(c)>-1) val += c }
-""" % alphabet # TODO: what if user types letters with diacritics, when remove_utf8_diacritics is set?
-else: js_alphabet = ""
-if more_sensible_punctuation_sort_order: js_alphabet = "val = val.replace(/-/g,' ').replace(/,/g,'~COM~').replace(/;/g,',').replace(/~COM~/g,';').replace(/ /g,';').replace(/([;,]);+/g,'$1');" + js_alphabet
+prevLink = '<p><a name="_h" href="%s.html#_f">Previous page</a></p>'
+nextLink = '<p><a name="_f" href="%s.html#_h">Next page</a></p>'
+hashedPrevLink = '<p><a name="_h" href="index.html#%s">Previous page</a></p>' # (for hashed_names, see pageLinks)
+hashedNextLink = '<p><a name="_f" href="index.html#%s">Next page</a></p>'
+
+linkRe = re.compile(r'(?i)<a href=("?)#')
+def linkSub(txt): return linkRe.sub(r'<a href=\1index.html#',txt) # (do link to index.html#whatever rather than directly, so link still works if docs change)
+
+def B(s):
+    if type(s)==type(u""): return s.encode('utf-8')
+    else: return s # Python 2 str is already bytes
+def byteLen(s): return len(B(s))
+
+class PageSizer:
+    "Predicts len(htmlDoc(start,end,prevName,nextName)) in UTF-8 bytes from running totals, so segmentation doesn't have to build each candidate page"
+    def __init__(self,build):
+        self.build = build
+        self.base = byteLen(linkSub(build.header)) + byteLen(js_hashjump([],build.external_js,build.front_coding)) + byteLen(linkSub(build.footer))
+        self.size,self.tagBytes,self.tagCount = [0],[0],[0]
+        self.front_coding,prev = build.front_coding,""
+        for x,y in build.fragments:
+            self.size.append(self.size[-1]+byteLen(build.rendered(x,y)))
+            if x: # hashtag array entry plus its separator
+                if self.front_coding: self.tagBytes.append(self.tagBytes[-1]+byteLen(frontCoded(prev,x))+1) ; prev = x
+                else: self.tagBytes.append(self.tagBytes[-1]+byteLen(x)+1)
+                self.tagCount.append(self.tagCount[-1]+1)
+            else:
+                self.tagBytes.append(self.tagBytes[-1])
+                self.tagCount.append(self.tagCount[-1])
+        if self.front_coding: # the first hashtag on a page is coded in full, so we need to know where it is and how much bigger it is
+            self.firstTag,self.extra = [len(build.fragments)]*len(build.fragments),{}
+            for i in xrange(len(build.fragments)-1,-1,-1):
+                x = build.fragments[i][0]
+                if x:
+                    self.firstTag[i] = i
+                    self.extra[i] = byteLen(frontCoded("",x))+1 - (self.tagBytes[i+1]-self.tagBytes[i])
+                elif i+1 < len(build.fragments): self.firstTag[i] = self.firstTag[i+1]
+    def __call__(self,start,end,prevName,nextName):
+        s = self.base + self.size[end]-self.size[start] + self.tagBytes[end]-self.tagBytes[start]
+        if self.tagCount[end] > self.tagCount[start]:
+            s -= 1 # n-1 separators
+            if self.front_coding: s += self.extra[self.firstTag[start]]
+        return s + sum(byteLen(l) for l in self.build.pageLinks(start,end,prevName,nextName))
 
 def hashReload(footer):
     # If a footer refers to index.html#example, need to
@@ -215,16 +1055,7 @@ def hashReload(footer):
         if i==-1: return footer
         footer = footer[:i]+'<a onclick="document.forms[0].q.value=\''+footer[i+len(strToFind):footer.index('"',i+len(strToFind))]+'\';jump()" href="index.html#'+footer[i+len(strToFind):]
 
-open(outdir+os.sep+"index.html","w").write("""%s<script><!--
-function jump() {
-  var val=document.forms[0].q.value; %s
-  location.href=%s(%s,val)+".html#"+val
-}
-if(navigator.userAgent.indexOf("Opera/9.50" /* sometimes found on WM6.1 phones from 2008 */) >= 0) document.write("<p><b>WARNING:</"+"b> Your version of Opera may have trouble jumping to anchors; please try Opera 10 or above.</"+"p>")
-//-->
-</script><noscript><p><b>ERROR:</b> Javascript needs to be switched on for this form to work.</p></noscript>
-<form action="#" onSubmit="jump();return false">Lookup: <input type="text" name="q"><input type="submit" value="ok"></form><script><!--
-if(location.hash.length > 1) { document.forms[0].q.value = location.hash.slice(1).replace(/(\+|%%20)/g,' '); jump(); } else document.forms[0].q.focus();
-//-->
-</script>%s""" % (hashReload(linkSub(header)),js_alphabet,js_binchop_dx,old_javascript_array(fragments[s][0] for s in startsList),hashReload(linkSub(footer))))
-sys.stderr.write(" %d files\n" % (len(startsList)+1))
+if __name__=="__main__":
+    if profiles: build_profiles(infile,profiles)
+    elif collection: build_collection(collection,outdir)
+    else: build_index(infile,outdir)
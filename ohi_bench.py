@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Benchmarks for Offline HTML Indexer (ohi.py)
+# (c) 2013-15,20,23-24 Silas S. Brown.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run with: python3 ohi_bench.py [--scale 10] [--output results.json]
+# Builds a synthetic CEDICT-sized dictionary (or a multiple
+# of it) and times each stage of ohi.py on it, recording
+# peak memory in a second pass (Python 3.9+), and writes
+# the results as JSON so they can be compared between
+# releases.  --alphaOnly N instead times the compiled
+# alphaOnly sort-key function against the composed
+# (reference) one on N headings, for each combination of
+# sort options.
+
+# Where to find history:
+# on GitHub at https://github.com/ssb22/indexer
+# and on GitLab at https://gitlab.com/ssb22/indexer
+# and on BitBucket https://bitbucket.org/ssb22/indexer
+# and at https://gitlab.developers.cam.ac.uk/ssb22/indexer
+# and in China: https://gitee.com/ssb22/indexer
+
+import os, io, time, random, json, platform, re, tempfile, shutil, argparse, contextlib, tracemalloc, ohi
+
+initials = "b p m f d t n l g k h j q x zh ch sh r z c s y w".split()+[""]
+finals = "a o e ai ei ao ou an en ang eng ong i ia ie iao iu ian in iang ing iong u ua uo uai ui uan un uang ueng ü üe".split()
+tones = {"a":u"āáǎà","o":u"ōóǒò","e":u"ēéěè","i":u"īíǐì","u":u"ūúǔù","ü":u"ǖǘǚǜ"}
+
+def syllable(r):
+    s = r.choice(initials)+r.choice(finals)
+    tone = r.randint(0,4)
+    if tone: # mark goes on a, o or e if present, otherwise the last vowel
+        i = min((s.find(v) for v in "aoe" if v in s),default=max(s.rfind(v) for v in u"iuü"))
+        s = s[:i]+tones[s[i]][tone-1]+s[i+1:]
+    return s
+
+def headings(n,seed=0):
+    "Returns n synthetic headings: pinyin with tone marks, some with hyphens, commas, semicolons or parenthesised glosses"
+    r = random.Random(seed) ; h = []
+    for _ in range(n):
+        w = ''.join(syllable(r) for _ in range(r.randint(1,4)))
+        c = r.random()
+        if c < 0.1: w = "-"+w
+        elif c < 0.2: w += ", "+syllable(r)
+        elif c < 0.3: w += " (" + r.choice(["classifier","surname","variant"]) + ")"
+        elif c < 0.35: w += "; "+syllable(r)
+        h.append(w)
+    return h
+
+cedictLines = 120000 # roughly the number of entries in CC-CEDICT
+english = "to be have do say go get make know think take see come want look use find give tell work call try ask need feel become leave put mean keep let begin seem help talk turn start show hear play run move like live believe hold bring happen write provide sit stand lose pay meet include continue set learn change lead understand watch follow stop create speak read allow add spend grow open walk win offer remember love consider appear buy wait serve die send expect build stay fall cut reach kill remain person year way day thing man world life hand part child eye woman place week case point government company number group problem fact water mountain river city country surname old variant of classifier for".split()
+
+def dictionary(lines=cedictLines,seed=0):
+    """Returns synthetic HTML in the style of c2h.py's output for 'lines' CEDICT-like entries: Chinese characters, pinyin with tone marks and English definitions, each of which is a heading, with some definitions cross-linking to an earlier entry"""
+    r = random.Random(seed) ; out,pinyins = ['<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body>\n'],[]
+    for _ in range(lines):
+        n = r.randint(1,4)
+        hanzi = ''.join(chr(r.randint(0x4e00,0x9fa5)) for _ in range(n))
+        pinyin = ' '.join(syllable(r) for _ in range(n))
+        defs = [' '.join(r.choice(english) for _ in range(r.randint(1,4))) for _ in range(r.randint(1,3))]
+        if pinyins and r.random() < 0.2:
+            p = r.choice(pinyins) ; defs.append('see also <a href="#%s">%s</a>' % (p,p))
+        pinyins.append(pinyin)
+        for h in [pinyin]+[d for d in defs if not '<' in d]:
+            out.append('<a name="%s"></a>%s %s [%s] /%s/\n<p>\n' % (h,hanzi,hanzi,pinyin,'/'.join(defs).replace(h,'<b>'+h+'</b>',1)))
+    out.append('<a name=""></a><hr>Synthetic data from ohi_bench.py</body></html>')
+    return ''.join(out)
+
+class Stages:
+    "Context manager factory recording each stage's time, and its tracemalloc peak and retained memory if tracing"
+    def __init__(self): self.results = {}
+    @contextlib.contextmanager
+    def __call__(self,name):
+        tracing = tracemalloc.is_tracing()
+        if tracing: tracemalloc.reset_peak()
+        t = time.time() ; yield
+        r = self.results[name] = {"seconds":time.time()-t}
+        if tracing: r["retained_bytes"],r["peak_bytes"] = tracemalloc.get_traced_memory()
+
+def bench_stages(text,outdir,**config):
+    "Runs ohi.py's build on 'text' one stage at a time (as build_index would) writing to outdir, returning {stage: {'seconds':...}}"
+    B,stage = ohi.Build(config),Stages()
+    with contextlib.redirect_stderr(io.StringIO()):
+        parallel = B.zero_copy and B.ingest_processes != 1
+        with stage("read/split"):
+            if B.zero_copy: reader = B.mapped = ohi.MappedInput(io.StringIO(text))
+            else: reader = ohi.AnchorReader(io.StringIO(text))
+            if not parallel: headings,fragments = zip(*reader)
+        with stage("alphaOnly"):
+            if parallel: keys,fragments = zip(*reader.keyed(B.alphaOnly,B.ingest_processes or ohi.cpu_count())) # (which splits in parallel too)
+            else: keys = [B.alphaOnly(h) for h in headings] ; del headings
+        B.header,B.footer = reader.header,reader.footer
+        with stage("sort"):
+            pairs = list(zip(keys,fragments))
+            if B.zero_copy: B.sortMapped(pairs)
+            else: pairs.sort()
+        del keys,fragments
+        with stage("ChangedLetters"): B.fragments = B.minimised(pairs)
+        del pairs
+        with stage("segmentation"): segments = list(B.segment())
+        with stage("file writing"): B.write(outdir,segments)
+    return stage.results
+
+class RegexWork:
+    """Context manager counting linkSub's calls and the
+    characters it scans, and the characters of every
+    htmlDoc result (all of which linkSub scanned again
+    before fragments were rendered once in minimised),
+    less what linkSub still scans for htmlDoc, as the
+    number of characters saved"""
+    def __enter__(self):
+        self.linkSub,self.htmlDoc = ohi.linkSub,ohi.Build.htmlDoc
+        self.work = {"calls":0,"chars":0,"htmlDoc_chars":0,"chars_saved":0}
+        def linkSub(txt):
+            self.work["calls"] += 1 ; self.work["chars"] += len(txt)
+            return self.linkSub(txt)
+        def htmlDoc(*args):
+            scanned = self.work["chars"]
+            doc = self.htmlDoc(*args)
+            self.work["htmlDoc_chars"] += len(doc)
+            self.work["chars_saved"] += len(doc) - (self.work["chars"]-scanned)
+            return doc
+        ohi.linkSub,ohi.Build.htmlDoc = linkSub,htmlDoc
+        return self.work
+    def __exit__(self,*args): ohi.linkSub,ohi.Build.htmlDoc = self.linkSub,self.htmlDoc
+
+def run(text,memory=True,**config):
+    """Returns timings of each stage on 'text', then
+    (from a second run, as counting slows it down) the
+    regex work done by linkSub and, if memory is set,
+    peak memory of each stage"""
+    outdir = tempfile.mkdtemp()
+    try:
+        results = bench_stages(text,outdir,**config)
+        shutil.rmtree(outdir) ; os.mkdir(outdir)
+        if memory: tracemalloc.start()
+        try:
+            with RegexWork() as work: traced = bench_stages(text,outdir,**config)
+        finally:
+            if memory: tracemalloc.stop()
+        if memory:
+            for k,v in traced.items(): results[k].update((m,v[m]) for m in ["peak_bytes","retained_bytes"])
+        results["files"],results["linkSub"] = len(os.listdir(outdir)),work
+    finally: shutil.rmtree(outdir)
+    return results
+
+def timed(f,h):
+    t = time.time()
+    for x in h: f(x)
+    return time.time()-t
+
+def bench_alphaOnly(h):
+    print("alphabet  parens punct diacritics   composed  compiled  speed-up")
+    for alphabet in [None,ohi.alphabet]:
+        for flags in [(a,b,c) for a in [0,1] for b in [0,1] for c in [0,1]]:
+            reference,a2 = ohi.composedSortKeyFunction(alphabet,*flags)
+            compiled = ohi.compiledSortKeyFunction(reference,a2,*flags)
+            assert [compiled(x) for x in h[:1000]] == [reference(x) for x in h[:1000]]
+            t0,t1 = timed(reference,h),timed(compiled,h)
+            print("%-8s  %-6s %-5s %-10s  %7.3fs  %7.3fs  %7.1fx" % (("yes" if alphabet else "no",)+tuple("yes" if f else "no" for f in flags)+(t0,t1,t0/t1)))
+
+def main():
+    args = argparse.ArgumentParser(description="Benchmarks for ohi.py")
+    args.add_argument("--scale",type=float,default=1,help="dictionary size as a multiple of CEDICT (default 1)")
+    args.add_argument("--seed",type=int,default=0)
+    args.add_argument("--zero-copy",action="store_true",help="set zero_copy")
+    args.add_argument("--ingest-processes",type=int,default=1,metavar="N",help="set ingest_processes (with --zero-copy)")
+    args.add_argument("--no-memory",action="store_true",help="skip the second (memory-tracing) pass")
+    args.add_argument("--output",help="file to write JSON results to (default standard output)")
+    args.add_argument("--alphaOnly",type=int,metavar="N",help="instead just compare alphaOnly speeds on N headings")
+    args = args.parse_args()
+    if args.alphaOnly:
+        h = headings(args.alphaOnly)
+        print("%d headings" % len(h))
+        return bench_alphaOnly(h)
+    t = time.time()
+    text = dictionary(int(cedictLines*args.scale),args.seed)
+    results = {
+        "ohi_version": re.search("Offline HTML Indexer v([0-9.]+)",open(ohi.__file__,encoding="utf-8").read()).group(1),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scale": args.scale,
+        "lines": int(cedictLines*args.scale),
+        "bytes": len(text.encode("utf-8")),
+        "generation_seconds": time.time()-t,
+        "zero_copy": args.zero_copy,
+        "ingest_processes": args.ingest_processes,
+        "stages": run(text,not args.no_memory and hasattr(tracemalloc,"reset_peak"),zero_copy=args.zero_copy,ingest_processes=args.ingest_processes)}
+    results["files"] = results["stages"].pop("files")
+    results["linkSub"] = results["stages"].pop("linkSub")
+    if args.output: json.dump(results,open(args.output,"w"),indent=1)
+    else: print(json.dumps(results,indent=1))
+
+if __name__=="__main__": main()
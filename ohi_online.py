@@ -34,7 +34,9 @@
 
 html_filename = "input.html" # set this to whatever
 # - and when that file changes, this script will update
-# files with that plus .index, .header and .footer
+# files with that plus .index, .lines, .header and .footer
+# (one process at a time, using .lock; the others keep
+# using the old files until the new ones are ready)
 # (it might be a good idea to do a separate run of this
 # script, from the command line, to perform that update,
 # especially if you're on a slow machine and the webserver
@@ -45,6 +47,15 @@ html_filename = "input.html" # set this to whatever
 # import ohi_online; the compiled version can then be used
 # after the first time)
 
+index_block_size = 64*1024 # roughly how much of html_filename
+# is checksummed together: when it changes, only the
+# blocks that changed are scanned again
+
+binary_index = False # if True, .index is also converted to
+# .bindex, which lookups then use instead: its sorted keys,
+# headings and ranges are found from fixed-width records
+# without parsing any text
+
 alphabet = "abcdefghijklmnopqrstuvwxyz" # set to None for all characters and case-sensitive; any headings not containing ANY of these characters will be put in as-is anyway
 
 # ignore_text_in_parentheses NOT available in the online version because it could make it impossible to fetch entries that differ from others only in parenthetical additions (unless you merge the entries, which might not be a good idea)
@@ -78,6 +89,24 @@ web_adjuster_extension_mode = False
 # If set to True, this module's handle() will work - see
 # Web Adjuster 'extensions' option for more details.
 # If set to False, we just behave as a CGI script.
+# (Alternatively, 'application' is a WSGI application, or
+# run this script with --serve [port] to serve on its own:
+# either way the index stays loaded between requests,
+# being reloaded only when html_filename changes.  Requests
+# can be handled in several threads at once.)
+
+compress_responses = True # gzip (or deflate) responses
+# for browsers that say they accept it
+stream_expansions_over = None # or e.g. 64*1024 to send
+# expansions of entries longer than this many bytes (and
+# compress them) a piece at a time, not caching them; this
+# calls preprocess_result on each entry separately, so set
+# it only if your preprocess_result doesn't need them all
+
+response_cache_size = 1000 # number of rendered lookups
+# to keep in memory (for the same version of the index) when
+# this module is used by Web Adjuster or as a WSGI
+# application (see below), for the most frequent lookups
 
 web_adjuster_extension_url = "http://example.org/ohi.cgi"
 web_adjuster_extension_url2 = "http://localhost/ohi.cgi"
@@ -100,14 +129,16 @@ except ImportError: ohi_config = None
 
 gemini_mode = os.environ.get("SERVER_PROTOCOL","")=="GEMINI"
 
-import cgi # used only for cgi.parse().  if this fails (Python 3.13+, e.g. Debian 13 + expected in Ubuntu 26.04 LTS) then you might want "pip install legacy-cgi" or "sudo apt install python3-legacy-cgi"
-
-if not web_adjuster_extension_mode and not gemini_mode:
+if not web_adjuster_extension_mode and not gemini_mode and "GATEWAY_INTERFACE" in os.environ: # running as a CGI
     import cgitb ; cgitb.enable() # remove this if you don't want tracebacks in the browser
 
-import mmap, os, re
+import mmap, os, re, array, struct, json, hashlib, email.utils, zlib, itertools, threading
+try: from collections import OrderedDict
+except ImportError: OrderedDict = None # Python 2.6: no response cache
 try: from urllib import quote # Python 2
 except ImportError: from urllib.parse import quote # Python 3
+try: from urlparse import parse_qs # Python 2
+except ImportError: from urllib.parse import parse_qs # Python 3
 if ohi_config:
     ohi_config.quote = quote # so functions there can use it
     from ohi_config import *
@@ -123,42 +154,138 @@ def create_linemap(fName):
     lm = LineMap(f.fileno(), 0, access=mmap.ACCESS_READ)
     lm.f = f # ensure not closed by gc
     return lm
-class LineMap(mmap.mmap): # might fail in old Python versions where mmap isn't a class
-    def linesAround(self,txt,linesBefore,linesAfter):
-        "returns (before,line,after), up to numLines lines either side of the line appropriate for txt"
-        self.seek(self.bisect(txt))
-        linesBefore = sum(self.back_line() for i in xrange(linesBefore))
-        return [self.readline() for i in xrange(linesBefore)],self.readline(),[x for x in [self.readline() for i in xrange(linesAfter)] if x]
-    def bisect(self,txt,lo=0,hi=-1):
-        "returns pos of start of appropriate line"
-        txt = B(txt)
-        if hi==-1: hi=len(self)
-        elif hi <= lo:
-            # return self.lineStart(hi)
-            # amendment: if only the first few characters matched, it's possible that the PREVIOUS entry will match more characters (positioning is rarely helped by an inserted character, e.g. a pinyin shen/sheng confusion, and we probably want to draw more attention to the previous entries in this case, especially if the following entries are completely different e.g. 'shi'; TODO: could even do full 'first entry that matches as many characters as possible' logic)
-            ret = self.lineStart(hi)
-            if ret==0 or self[ret:ret+len(txt)]==txt: return ret # all characters match current line, or there are no previous lines
-            txt2 = txt
-            while len(txt2)>1 and not self[ret:ret+len(txt2)]==txt2: txt2 = txt2[:-1] # delete characters from the end until all that are left match current line
-            ret2 = self.lineStart(ret-1)
-            if self[ret2:ret2+len(txt2)+1]==txt[:len(txt2)+1]: return ret2 # return previous line if they match that as well
-            else: return ret
-        lWidth = int((hi-lo)/2)
-        lMid = self.lineStart(lo+lWidth)
-        lLine = self.lineAt(lMid)
-        if lLine < txt: return self.bisect(txt,lMid+len(lLine),hi)
-        else: return self.bisect(txt,lo,lMid)
-    def lineStart(self,pos):
-        return self.rfind(B("\n"),0,pos)+1 # (for start of file, rfind will return -1 so this+1 is still what we want)
-    def lineAt(self,pos):
-        self.seek(pos) ; return self.readline()
-    def back_line(self):
-        p = self.tell()
-        if not p: return 0
-        elif self[p-1:p]==B('\n'):
-            self.seek(self.lineStart(p-1))
-        else: self.seek(self.lineStart(p))
-        return 1
+class IndexLookup(object):
+    "Lookups in LineMap (.index) or BinaryIndex, which give the number of entries (self.n), the text to compare for each (self.line(i), empty for i==n) and its (key,heading,[(start,end),...]) (self.entry(i))"
+    def entriesAround(self,txt,linesBefore,linesAfter):
+        "returns (before,entry,after), up to numLines entries either side of the one appropriate for txt"
+        i = self.bisect(txt)
+        return [self.entry(j) for j in xrange(max(0,i-linesBefore),i)],self.entry(i),[self.entry(j) for j in xrange(i+1,min(i+1+linesAfter,self.n))]
+    def bisect(self,txt):
+        "returns number of appropriate entry"
+        txt = B(txt) ; lo,hi = 0,self.n
+        while lo < hi:
+            mid = int((lo+hi)/2)
+            if self.line(mid) < txt: lo = mid+1
+            else: hi = mid
+        # amendment: if only the first few characters matched, it's possible that the PREVIOUS entry will match more characters (positioning is rarely helped by an inserted character, e.g. a pinyin shen/sheng confusion, and we probably want to draw more attention to the previous entries in this case, especially if the following entries are completely different e.g. 'shi'; TODO: could even do full 'first entry that matches as many characters as possible' logic)
+        line = self.line(hi)
+        if hi==0 or line[:len(txt)]==txt: return hi # all characters match current line, or there are no previous lines
+        txt2 = txt
+        while len(txt2)>1 and not line[:len(txt2)]==txt2: txt2 = txt2[:-1] # delete characters from the end until all that are left match current line
+        if self.line(hi-1)[:len(txt2)+1]==txt[:len(txt2)+1]: return hi-1 # return previous line if they match that as well
+        else: return hi
+
+class LineMap(IndexLookup,mmap.mmap): # might fail in old Python versions where mmap isn't a class
+    # (for .index, .lines and .n must be set: see create_indexmap)
+    def line(self,i):
+        "returns line number i (with its newline), or empty if there isn't one"
+        if i < self.n: return self[self.lines[i]:self.lines[i+1]]
+        else: return B("")
+    def entry(self,i):
+        line = U(self.line(i)).split("\t")
+        if len(line)==1: return u"",u"",[]
+        return line[0],line[1],[(int(a),int(b)) for a,b in zip(line[2::2],line[3::2])]
+
+class BinaryIndex(IndexLookup):
+    """The .bindex file: binaryMagic, the number of
+    entries n, then n+1 records of (key offset, heading
+    offset, number of the entry's first range), then
+    (start,end) for each range, as Numbers, then the keys
+    and the headings (UTF-8), all memory-mapped.  The
+    last record says where the last entry's key, heading
+    and ranges end."""
+    def __init__(self,fName):
+        self.q = Numbers(fName) ; self.m = self.q.m
+        assert self.m[:8]==binaryMagic, fName+" is not a binary index"
+        self.n = self.q[1] ; self.ranges = 2+3*(self.n+1)
+    def line(self,i):
+        if i < self.n: return self.key(i)+B("\t") # (compares as .index lines do)
+        else: return B("")
+    def key(self,i): return self.m[self.q[2+3*i]:self.q[5+3*i]]
+    def entry(self,i):
+        if i >= self.n: return u"",u"",[]
+        q,r = self.q,2+3*i
+        return U(self.key(i)),U(self.m[q[r+1]:q[r+4]]),[(q[self.ranges+2*j],q[self.ranges+2*j+1]) for j in xrange(q[r+2],q[r+5])]
+binaryMagic = B("OHIbin01")
+def write_binary_index(fName,index):
+    "Writes fName (see BinaryIndex) from the lines of .index"
+    keys,headings,ranges,first = [],[],[],[]
+    for line in index:
+        line = line.rstrip(B("\n")).split(B("\t"))
+        first.append(int(len(ranges)/2)) ; keys.append(line[0]) ; headings.append(line[1])
+        ranges += [int(x) for x in line[2:]]
+    n = len(keys) ; first.append(int(len(ranges)/2))
+    keyOffset = 8*(2+3*(n+1)+len(ranges))
+    headingOffset = keyOffset+sum(len(k) for k in keys)
+    records = []
+    for i in xrange(n+1):
+        records += [keyOffset,headingOffset,first[i]]
+        if i < n: keyOffset,headingOffset = keyOffset+len(keys[i]),headingOffset+len(headings[i])
+    f = open(fName,"wb")
+    f.write(binaryMagic+packed([n]+records+ranges))
+    for k in keys: f.write(k)
+    for h in headings: f.write(h)
+    f.close()
+
+class Numbers:
+    "Unsigned 64-bit little-endian numbers from the start of a file, memory-mapped"
+    def __init__(self,fName):
+        self.f = open(fName,"rb")
+        self.m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if sys.byteorder=="little" and hasattr(memoryview,"cast"): self.a = memoryview(self.m)[:len(self)*8].cast('Q') # Python 3
+        else: self.a = None
+    def __len__(self): return int(len(self.m)/8)
+    def __getitem__(self,i):
+        if self.a is None: return struct.unpack_from("<Q",self.m,8*i)[0]
+        return self.a[i]
+def packed(numbers):
+    "Returns 'numbers' as the bytes of a Numbers file"
+    try: a = array.array('Q',numbers)
+    except ValueError: return struct.pack("<%dQ" % len(numbers),*numbers) # Python 2 (no 'Q')
+    if sys.byteorder=="big": a.byteswap()
+    try: return a.tobytes()
+    except AttributeError: return a.tostring() # Python 2
+def derived_name(fName):
+    "The file made from fName.index for lookups: .bindex if binary_index is set, otherwise .lines"
+    if binary_index: return fName+".bindex"
+    else: return fName+".lines"
+def write_derived(derived,index):
+    "Writes the .lines or .bindex file 'derived' from the .index file 'index'"
+    if binary_index: return write_binary_index(derived,open(index,"rb"))
+    lm = create_linemap(index)
+    open(derived,"wb").write(packed([0]+[m.end() for m in re.finditer(B("\n"),lm)]))
+def create_indexmap(fName):
+    "create_linemap for fName.index with its .lines, or BinaryIndex of its .bindex if binary_index is set"
+    if binary_index:
+        bi = BinaryIndex(fName+".bindex")
+        bi.mtime = os.fstat(bi.q.f.fileno()).st_mtime # (identifies this version of the index)
+        return bi
+    lm = create_linemap(fName+".index")
+    lm.lines = Numbers(fName+".lines") ; lm.n = len(lm.lines)-1
+    lm.mtime = os.fstat(lm.f.fileno()).st_mtime
+    return lm
+
+try: import fcntl
+except ImportError: fcntl = None # not Unix: no locking
+class IndexLock:
+    """Locks in fName.lock: byte 0 is held by whoever is
+    updating the index files, and byte 1 is held shared
+    while opening them and exclusively while replacing
+    them (POSIX locks, so they're per process)"""
+    updating,opening = 0,1
+    def __init__(self,fName): self.f = open(fName+".lock","a+") # (shared locks need read access)
+    def lock(self,byte,exclusive=False,wait=True):
+        "Returns False if wait is False and someone else has it"
+        if not fcntl: return True
+        mode = (fcntl.LOCK_SH,fcntl.LOCK_EX)[exclusive]
+        if not wait: mode |= fcntl.LOCK_NB
+        try: fcntl.lockf(self.f,mode,1,byte)
+        except (IOError,OSError): # (EAGAIN or EACCES)
+            if wait: raise
+            return False
+        return True
+    def unlock(self,byte):
+        if fcntl: fcntl.lockf(self.f,fcntl.LOCK_UN,1,byte)
 
 if alphabet and more_sensible_punctuation_sort_order: alphaOnly = lambda x: re.sub('([;,]);+',r'\1',''.join(c for c in x.lower().replace('-',' ').replace(',','~COM~').replace(';',',').replace('~COM~',';').replace(' ',';') if c in alphabet+',;')) # gives ; < , == space (useful if ; is used to separate definitions and , is used before extra words to be added at the start; better set space EQUAL to comma, not higher, or will end up in wrong place if user inputs something forgetting the comma)
 elif alphabet: alphaOnly = lambda x: ''.join(c for c in x.lower() if c in alphabet)
@@ -180,45 +307,206 @@ if remove_utf8_diacritics:
     alphaOnly = lambda x: _ao(S(u''.join((c for c in unicodedata.normalize('NFD',U(x)) if not unicodedata.category(c).startswith('M')))))
 
 def load(fName):
-  txt = create_linemap(fName)
+  """Returns (txt,index,header,footer) for fName, first
+  updating the index files if fName is newer.  Only one
+  process does this at a time (see update): the others
+  carry on with the old files meanwhile if they can
+  (i.e. if fName has only been added to, so the old
+  index's byte ranges still hold), else they wait."""
+  txt = create_linemap(fName) ; lock = IndexLock(fName)
+  lock.lock(lock.opening)
+  try:
+    indexFresh,derivedFresh = index_state(fName)
+    if indexFresh and derivedFresh: return (txt,)+open_index(fName)
+    elif derivedFresh and appended_only(fName,txt): old = open_index(fName) # (the previous generation)
+    else: old = None
+  finally: lock.unlock(lock.opening)
+  if not lock.lock(lock.updating,True,wait=not old): return (txt,)+old # someone else is updating
+  try:
+    indexFresh,derivedFresh = index_state(fName) # (someone else might have done it while we waited)
+    if not (indexFresh and derivedFresh): update(fName,txt,lock,indexFresh)
+  finally: lock.unlock(lock.updating)
+  lock.lock(lock.opening)
+  try: return (txt,)+open_index(fName)
+  finally: lock.unlock(lock.opening)
+
+def index_state(fName):
+  "Returns (whether fName.index is up to date with fName, whether derived_name is up to date with fName.index)"
+  try: indexTime = os.stat(fName+".index").st_mtime
+  except OSError: return False,False
+  try: derivedFresh = os.stat(derived_name(fName)).st_mtime >= indexTime
+  except OSError: derivedFresh = False
+  return os.stat(fName).st_mtime <= indexTime,derivedFresh
+
+def appended_only(fName,txt):
+  "Returns True if txt still starts with what fName.index was made from (checked against fName.blocks, see rescan)"
   try:
-    if os.stat(fName).st_mtime <= os.stat(fName+".index").st_mtime:
-      return txt,create_linemap(fName+".index"),open(fName+".header").read(),open(fName+".footer").read()
-  except OSError: pass
-  ret = {}
-  contentStart = 0 ; header="" ; tag = ""
+    old = json.load(open(fName+".blocks"))
+    if old["index_size"]!=os.stat(fName+".index").st_size: return False
+    blocks = old["blocks"]
+  except (IOError,OSError,ValueError,KeyError): return False
+  return all(a+l <= len(txt) and hashlib.sha1(txt[a:a+l]).hexdigest()==h for a,l,h in blocks)
+
+def open_index(fName): return create_indexmap(fName),open(fName+".header").read(),open(fName+".footer").read()
+
+def update(fName,txt,lock,indexFresh=False):
+  """Writes the index files of fName (or, if indexFresh,
+  just remakes its .lines or .bindex) to temporary files
+  and then replaces the old ones while nobody is opening
+  them, so they're never seen half-written"""
+  new = ".new%d" % os.getpid() ; replacing = [derived_name(fName)]
+  if indexFresh: index = fName+".index"
+  else:
+    mtime = os.stat(fName).st_mtime # (before scanning, in case it changes again meanwhile)
+    index,header,footer,blocks = rescan(fName,txt) or scan(txt)
+    open(fName+".index"+new,"w").write(index)
+    os.utime(fName+".index"+new,(mtime,mtime)) # so it's up to date with this version of fName
+    open(fName+".header"+new,"w").write(header)
+    open(fName+".footer"+new,"w").write(footer)
+    json.dump({"block_size":index_block_size,"blocks":blocks,"index_size":os.stat(fName+".index"+new).st_size},open(fName+".blocks"+new,"w"))
+    index = fName+".index"+new ; replacing += [fName+".header",fName+".footer",fName+".blocks",fName+".index"]
+  write_derived(replacing[0]+new,index)
+  lock.lock(lock.opening,True)
+  try:
+    for f in replacing: getattr(os,"replace",os.rename)(f+new,f) # (os.rename also replaces atomically on Unix, for Python 2)
+  finally: lock.unlock(lock.opening)
+
+anchor = re.compile(B(r'<a name="([^"]*)"></a>'))
+def entries(txt,start=0,end=None):
+  """Returns ([(heading,start,end),...],header,footer,
+  block starts) for txt[start:end] in order.  start is 0
+  or a block start, and end is a block start or the end
+  (header is only meaningful if start is 0, and footer
+  is None unless end is the end).  Blocks start at an
+  anchor at least index_block_size after the last one
+  that doesn't follow an empty entry, so the entries
+  in a block don't depend on what's outside it."""
+  if end is None: end,footer = len(txt),True
+  else: footer = None
+  ret,blocks = [],[start]
+  contentStart = None ; header="" ; tag = ""
   altTags = []
-  for m in re.finditer(B(r'<a name="([^"]*)"></a>'),txt):
+  for m in anchor.finditer(txt,start,end):
     # First, output the content from the PREVIOUS tag:
-    if contentStart and contentStart==m.start():
+    if contentStart==m.start():
         # oops, previous tag has NO content, so treat it as an 'alternate heading' to the tag we're about to have:
         altTags.append(tag)
     else:
-        for ttag in [tag]+altTags:
-            tag2 = alphaOnly(ttag)
-            if not tag2: tag2 = ttag
-            if contentStart:
-                if not tag2 in ret: ret[tag2] = (ttag,[])
-                ret[tag2][1].append("\t"+str(contentStart)+"\t"+str(m.start()))
-            else: # we're on the first tag
-                assert not altTags
-                header=txt[:m.start()]
-                if type(u"")==type(""): header=header.decode('utf-8') # Python 3
+        if contentStart is None: header = txt[start:m.start()] # we're on the first tag
+        else:
+            ret += [(ttag,contentStart,m.start()) for ttag in [tag]+altTags]
+            if m.start() >= blocks[-1]+index_block_size: blocks.append(m.start())
         altTags = []
     # Now look at the new tag:
     tag = m.group(1) ; contentStart = m.end()
     if type(u"")==type(""): tag=tag.decode('utf-8') # Python 3
-  footer = txt[contentStart:]
-  if type(u"")==type(""): footer=footer.decode('utf-8') # Python 3
+  if contentStart is None: contentStart = start
+  if footer: footer = txt[contentStart:]
+  else: ret += [(ttag,contentStart,end) for ttag in [tag]+altTags]
+  return ret,ST(header),footer,blocks
+
+def scan(txt):
+  "Returns the text of the .index, .header and .footer files for input txt, and its blocks (see rescan)"
+  ret,header,footer,blocks = entries(txt)
+  header,footer = with_defaults(header,ST(footer))
+  return index_text(grouped(ret)),header,footer,checksums(txt,blocks+[len(txt)])
+
+def with_defaults(header,footer):
   if not header.strip(): header='<html><head><meta name="mobileoptimized" content="0"><meta name="viewport" content="width=device-width"><script>if(window.matchMedia && window.matchMedia("(prefers-color-scheme: dark)").matches)document.write("<style>body { background-color: black; color: #c0c000; } a { color: #00b000; }</style>");</script></head><body>'
   if not footer.strip(): footer = '</body></html>'
-  try: ret = ret.iteritems() # Python 2
-  except: ret = ret.items() # Python 3
-  ret = [tag2+"\t"+ttag+"".join(rest)+"\n" for tag2,(ttag,rest) in ret] ; ret.sort()
-  open(fName+".index","w").write("".join(ret))
-  open(fName+".header","w").write(header)
-  open(fName+".footer","w").write(footer)
-  return txt,create_linemap(fName+".index"),header,footer
+  return header,footer
+
+def grouped(ret):
+  "Returns {key:(heading,[(start,end),...])} for entries (ret), each key's heading being its first"
+  index = {}
+  for ttag,start,end in ret:
+    tag2 = alphaOnly(ttag)
+    if not tag2: tag2 = ttag
+    if not tag2 in index: index[tag2] = (ttag,[])
+    index[tag2][1].append((start,end))
+  return index
+
+def index_text(index,lines=[]):
+  "Returns the text of the .index file for grouped entries (and any other lines of it)"
+  try: index = index.iteritems() # Python 2
+  except: index = index.items() # Python 3
+  index = [tag2+"\t"+ttag+"".join("\t%d\t%d" % r for r in rest)+"\n" for tag2,(ttag,rest) in index]+lines ; index.sort()
+  return "".join(index)
+
+def checksums(txt,starts):
+  "Returns [start,length,checksum] of each block (from each of 'starts' to the next)"
+  return [[a,b-a,hashlib.sha1(txt[a:b]).hexdigest()] for a,b in zip(starts,starts[1:])]
+
+def rescan(fName,txt):
+  """Like scan, but using fName.blocks to rescan only
+  the blocks that differ from those of the previous
+  version of fName: unchanged blocks are found from
+  the start and (shifted by any change in length) from
+  the end, and the entries of the rest (and of the
+  unchanged block either side of it, whose entries
+  might run into it) are rescanned and merged with the
+  others from fName.index.  Returns None if that's not
+  possible (so scan everything)."""
+  try:
+    old = json.load(open(fName+".blocks"))
+    if old["block_size"]!=index_block_size or old["index_size"]!=os.stat(fName+".index").st_size: return None
+    blocks,oldIndex = old["blocks"],open(fName+".index","rb").read()
+  except (IOError,OSError,ValueError,KeyError): return None
+  if not blocks: return None
+  oldLen,n = blocks[-1][0]+blocks[-1][1],len(blocks)
+  delta,p,s = len(txt)-oldLen,0,0
+  def same(i,d): return blocks[i][0]+d+blocks[i][1] <= len(txt) and hashlib.sha1(txt[blocks[i][0]+d:blocks[i][0]+d+blocks[i][1]]).hexdigest()==blocks[i][2]
+  while p < n and same(p,0): p += 1
+  while s < n-p and blocks[n-1-s][0]+delta >= blocks[p][0] and same(n-1-s,delta): s += 1
+  if p: start = blocks[p-1][0]
+  else: start = 0
+  if s > 1: oldEnd = blocks[n-s+1][0] ; end = oldEnd+delta
+  else: oldEnd,end = oldLen,None
+  ret,header,footer,newBlocks = entries(txt,start,end)
+  if start: header = open(fName+".header").read()
+  if end: footer = open(fName+".footer").read()
+  header,footer = with_defaults(header,ST(footer))
+  index,unchanged = grouped(ret),[]
+  for line in ST(oldIndex).split("\n")[:-1]:
+    if int(line.rsplit("\t",2)[1]) < start and not line[:line.index("\t")] in index: # (its ranges are in order, so it's all before 'start')
+      unchanged.append(line+"\n") ; continue
+    line = line.split("\t")
+    tag2,ranges = line[0],[(int(a),int(b)) for a,b in zip(line[2::2],line[3::2])]
+    before,after = [r for r in ranges if r[0] < start],[(a+delta,b+delta) for a,b in ranges if a >= oldEnd]
+    if not (before or after): continue
+    if tag2 in index:
+      ttag,rest = index[tag2]
+      if before: ttag = line[1]
+      index[tag2] = ttag,before+rest+after
+    elif before or ranges[0][0] >= oldEnd: index[tag2] = line[1],before+after # (its first heading is still there)
+    else: index[tag2] = heading_before(txt,after[0][0],tag2),after
+  blocks = blocks[:max(0,p-1)]+checksums(txt,newBlocks+[end or len(txt)])+[[a+delta,l,h] for a,l,h in blocks[n-s+1:] if s > 1]
+  return index_text(index,unchanged),header,footer,blocks
+
+def heading_before(txt,pos,tag2):
+  "Returns the heading with key tag2 of the anchor ending at pos, or if it's not that then of an anchor ending where that one starts etc (as scan would find it)"
+  tags = []
+  while True:
+    m = anchor.match(txt,max(0,txt.rfind(B('<a name="'),0,pos)),pos)
+    if not m or m.end() < pos: break
+    tags.append(ST(m.group(1))) ; pos = m.start()
+  for ttag in tags[:1]+tags[:0:-1]:
+    if (alphaOnly(ttag) or ttag)==tag2: return ttag
+
+loadedFiles,loading = {},threading.Lock()
+def loaded(fName):
+  "Returns load(fName), reusing the previous result if neither fName nor its index has changed since (for when we're not a CGI)"
+  with loading: # (IndexLock is per process, so threads take turns here)
+    mtimes = index_mtimes(fName)
+    if not fName in loadedFiles or loadedFiles[fName][0] != mtimes or not mtimes:
+      files = load(fName)
+      if not mtimes: mtimes = index_mtimes(fName) # (if it's now up to date)
+      loadedFiles[fName] = mtimes,files
+    return loadedFiles[fName][1]
+def index_mtimes(fName):
+  try: mtimes = os.stat(fName).st_mtime,os.stat(fName+".index").st_mtime
+  except OSError: return None
+  if mtimes[0] <= mtimes[1]: return mtimes
 
 if web_adjuster_extension_mode: cginame = web_adjuster_extension_url[web_adjuster_extension_url.rindex('/')+1:]
 else:
@@ -231,8 +519,9 @@ try: unichr # Python 2
 except: unichr = chr # Python 3
 def html2gmi(html): return re.sub("[&]#([0-9]+);",lambda m:unichr(int(m.group(1))),re.sub("[&]#x([0-9A-Fa-f]+);",lambda m:unichr(int(m.group(1),16)),re.sub("[&]([a-zA-Z0-9]+);",lambda m:unichr(htmlentitydefs.name2codepoint.get(m.group(1),63)),re.sub("\n+","\n",re.sub("<[^>]*>","",re.sub("<script>.*?</script>","",re.sub('<a href="([^"]*)"[^>]*>',r"\n=> \1 ",html.replace("<br>","\n").replace("</a>","\n")),flags=re.DOTALL)))))).replace("\n | \n","\n") # TODO: call into html2gmi.py for typography?
 
-def queryForm(prompt): return "<form action=\""+cginame+"\">"+prompt+'<input type="text" name="q"><input type="Submit" value="OK"></form>'
-def out(html="",req=None):
+def queryForm(prompt,cginame=cginame): return "<form action=\""+cginame+"\">"+prompt+'<input type="text" name="q"><input type="Submit" value="OK"></form>'
+def out(html="",req=None,cginame=cginame,header="",footer="",validators=[],encoding=None):
+  "Sends the page with 'html' (which can also be an iterable of pieces, if not gemini_mode) or the front page"
   if html: lookup_prompt = shorter_lookup_prompt
   else:
       lookup_prompt = frontpage_lookup_prompt
@@ -240,14 +529,82 @@ def out(html="",req=None):
           print ("10 "+html2gmi(shorter_lookup_prompt).strip().split("\n")[-1]+"\r") ; return
       html='<script><!--\ndocument.forms[0].q.focus();\n//-->\n</script>' # TODO: else which browsers need <br> after the </form> in the line below?
   if gemini_mode: html += "\n=> "+os.environ.get("SCRIPT_URI",cginame)+" Look up another word\n"
-  else: html = queryForm(lookup_prompt)+html
+  if type(html) in [type(""),type(u"")]: html = [html]
+  if gemini_mode and not req: print ("20 text/gemini; charset=utf-8\r\n"+html2gmi(html[0]))
+  else: send('text/html; charset=utf-8',itertools.chain([header]+[queryForm(lookup_prompt,cginame)]*(not gemini_mode),html,[footer]),req,validators,encoding)
+
+def send(contentType,pieces,req=None,validators=[],encoding=None):
+  "Sends a response of the strings in 'pieces' with the validators (see main), compressed a piece at a time if encoding is set (see accepted_encoding)"
+  headers = [("Content-type",contentType)]+validators
+  if encoding: headers.append(("Content-Encoding",encoding))
   if req:
-      req.set_header('Content-type','text/html; charset=utf-8')
-      req.write(B(header+html+footer))
-  elif gemini_mode: print ("20 text/gemini; charset=utf-8\r\n"+html2gmi(html))
-  else: print ("Content-type: text/html; charset=utf-8\n\n"+header+html+footer)
-def link(l,highl=""):
-  l,linkText,rest = U(l).split('\t',2) ; highl = U(highl)
+      for k,v in headers: req.set_header(k,v)
+      write = req.write
+  else:
+      sys.stdout.write("".join(k+": "+v+"\n" for k,v in headers)+"\n") ; sys.stdout.flush()
+      write = getattr(sys.stdout,"buffer",sys.stdout).write # (bytes in Python 3)
+  if encoding=="gzip": compressor = zlib.compressobj(6,zlib.DEFLATED,16+zlib.MAX_WBITS)
+  elif encoding: compressor = zlib.compressobj(6)
+  else: compressor = None
+  for p in pieces:
+      p = B(p)
+      if compressor: p = compressor.compress(p)
+      if p: write(p)
+  if compressor: write(compressor.flush())
+  elif not req: write(B("\n")) # as print() did
+
+def request_header(name,req=None):
+  if req: return req.request.headers.get(name)
+  else: return os.environ.get("HTTP_"+name.upper().replace("-","_"))
+
+def accepted_encoding(req=None):
+  "Returns 'gzip' or 'deflate' if compress_responses is set and the request's Accept-Encoding allows it (gzip preferred), otherwise None"
+  if not compress_responses or gemini_mode: return None
+  accepted = {}
+  for e in (request_header("Accept-Encoding",req) or "").lower().split(","):
+      e = e.split(";") ; q = 1
+      for param in e[1:]:
+          param = param.strip()
+          if param.startswith("q="):
+              try: q = float(param[2:])
+              except ValueError: q = 0
+      accepted[e[0].strip()] = q
+  for e in ["gzip","deflate"]:
+      if accepted.get(e,accepted.get("x-"+e,accepted.get("*",0))) > 0: return e
+
+def not_modified(req=None,validators=[]):
+  "If the request's If-None-Match or If-Modified-Since says the client has the version with these validators, sends 304 Not Modified and returns True"
+  if not validators: return False # (gemini_mode)
+  def get(h): return request_header(h,req)
+  etag,lastModified = dict(validators)["ETag"],dict(validators)["Last-Modified"]
+  if get("If-None-Match"): current = etag in [t.strip() for t in get("If-None-Match").split(",")] or get("If-None-Match").strip()=="*"
+  elif get("If-Modified-Since"):
+      t = email.utils.parsedate_tz(get("If-Modified-Since"))
+      current = t is not None and email.utils.mktime_tz(t) >= email.utils.mktime_tz(email.utils.parsedate_tz(lastModified))
+  else: current = False
+  if not current: return False
+  if req:
+      req.set_status(304)
+      for k,v in validators: req.set_header(k,v)
+  else: print ("Status: 304 Not Modified\n"+"".join(k+": "+v+"\n" for k,v in validators))
+  return True
+
+class ResponseCache:
+  "The response_cache_size most recently used rendered lookups for one version of the index"
+  def __init__(self): self.generation,self.responses = None,OrderedDict and OrderedDict()
+  def get(self,key,generation):
+    if generation != self.generation: self.generation,self.responses = generation,OrderedDict and OrderedDict()
+    if not self.responses or not key in self.responses: return None
+    r = self.responses.pop(key) ; self.responses[key] = r # (now most recent)
+    return r
+  def put(self,key,response):
+    if self.responses is None or not response_cache_size: return
+    self.responses[key] = response
+    while len(self.responses) > response_cache_size: self.responses.popitem(last=False)
+responses = ResponseCache()
+def link(entry,highl="",cginame=cginame):
+  l,linkText = entry[:2] ; highl = U(highl)
+  if not l: return "" # past the last entry
   mismatch = u""
   while highl and not l.startswith(highl): highl,mismatch=highl[:-1],highl[-1]+mismatch
   i = j = 0
@@ -266,7 +623,7 @@ def link(l,highl=""):
   return '<a href="'+cginame+'?q='+quote(undo_alphaOnly_swap(l))+'&e=1" onclick="return tryInline(this)">'+linkText+'</a>' # (this gives a 'click to expand/collapse' option on browsers that support it, TODO: configurable?  option to have onMouseOver previews somewhere??  careful as could run into trouble with user CSS files)
   # (Could shorten l to the shortest unique part of the word, but that might not be a good idea if the data can change while users are online)
   
-def redir(base,rest,req=None):
+def redir(base,rest,req=None,cginame=cginame):
   if not base:
       if web_adjuster_extension_mode: base = web_adjuster_extension_url
       else: base=os.environ.get("SCRIPT_URI",cginame) # cginame would make it a relative redirect, which might or might not work with the browser/server
@@ -279,7 +636,7 @@ def redir(base,rest,req=None):
       print ("Location: "+base+rest)
       print ("")
 
-def linkSub(txt): return re.sub(r'(?i)<a href=("?)#',r'<a href=\1'+cginame+'?e=1&q=',ST(txt))
+def linkSub(txt,cginame=cginame): return re.sub(r'(?i)<a href=("?)#',r'<a href=\1'+cginame+'?e=1&q=',ST(txt))
 
 def main(req=None):
   qs = os.environ.get('QUERY_STRING','')
@@ -289,7 +646,9 @@ def main(req=None):
       sys.stderr.write("Index is now up-to-date\n")
       return
   elif not '=' in qs and len(qs.strip()): return redir("","?t=1&q="+qs.strip()) # ?word -> ?q=word (especially for Gemini but anyway)
-  else: query = cgi.parse()
+  else:
+      import cgi # used only for cgi.parse().  if this fails (Python 3.13+, e.g. Debian 13 + expected in Ubuntu 26.04 LTS) then you might want "pip install legacy-cgi" or "sudo apt install python3-legacy-cgi"
+      query = cgi.parse()
   def qGet(k,default=""):
       v = query.get(k,default)
       if type(v)==list: v=v[0]
@@ -300,25 +659,43 @@ def main(req=None):
   a = int(qGet("a",lines_after))
   b = int(qGet("b",lines_before))
   e = qGet("e")
-  if q and not e and a==lines_after and b==lines_before and not query.get("t",""): return redir("","?q="+quote(undo_alphaOnly_swap(q))+"&t=1#e",req=req)
-  global header,footer
-  txt,index,header,footer = load(html_filename)
-  if not q: return out(req=req)
+  script = getattr(req,"cginame",cginame) # (per request in application)
+  if q and not e and a==lines_after and b==lines_before and not query.get("t",""): return redir("","?q="+quote(undo_alphaOnly_swap(q))+"&t=1#e",req,script)
+  txt,index,header,footer = loaded(html_filename)
+  encoding = accepted_encoding(req)
+  if gemini_mode: validators = []
+  else: validators = [("ETag",'"%x%s"' % (int(index.mtime*1000),encoding and "-"+encoding or "")),("Last-Modified",email.utils.formatdate(index.mtime,usegmt=True))]
+  if compress_responses and not gemini_mode: validators.append(("Vary","Accept-Encoding"))
+  if not_modified(req,validators): return
+  def reply(html=""): out(html,req,script,header,footer,validators,encoding)
+  if not q: return reply()
   q,q0 = alphaOnly(q),q
   if not q: q = q0
-  if e:
-    ranges = ST(index.linesAround(q,0,0)[1]).split("\t")[2:]
-    toOut = preprocess_result("<hr>".join(linkSub(txt[int(a):int(b)]) for a,b in zip(ranges[::2], ranges[1::2])))
-    if e=="2":
-        if req:
-            req.set_header('Content-type','text/plain; charset=utf-8')
-            req.write(toOut)
-        else: print ("Content-type: text/plain; charset=utf-8\n\n"+toOut) # for the XMLHttpRequest
-        return
-    else: return out(toOut,req=req)
-  b4,line,aftr = index.linesAround(q,b,a)
-  lnks = links_to_related_services(q0)
-  if lnks: lnks += '<hr>'
+  key = (q,a,b,e,gemini_mode,script)
+  toOut = responses.get(key,index.mtime)
+  if toOut is None and e and not gemini_mode and stream_expansions_over is not None:
+      ranges = index.entriesAround(q,0,0)[1][2]
+      if sum(b-a for a,b in ranges) > stream_expansions_over: toOut = expansion(txt,ranges,script,preprocess_result)
+  if toOut is None:
+      toOut = render(txt,index,q,a,b,e,script)
+      responses.put(key,toOut)
+  if e=="2": send('text/plain; charset=utf-8',[toOut] if type(toOut) in [type(""),type(u"")] else toOut,req,validators,encoding) # for the XMLHttpRequest
+  elif e: reply(toOut)
+  else:
+      lnks = links_to_related_services(q0)
+      if lnks: lnks += '<hr>'
+      reply(lnks+toOut)
+
+def expansion(txt,ranges,cginame,preprocess=lambda markup:markup):
+  "Yields the HTML of the entries at 'ranges' of txt a piece at a time, calling preprocess on each entry"
+  for i,(a,b) in enumerate(ranges):
+    if i: yield "<hr>"
+    yield preprocess(linkSub(txt[a:b],cginame))
+
+def render(txt,index,q,a,b,e,cginame):
+  "Returns the HTML for looking up q (already alphaOnly), apart from links_to_related_services, with links to cginame"
+  if e: return preprocess_result("".join(expansion(txt,index.entriesAround(q,0,0)[1][2],cginame)))
+  b4,line,aftr = index.entriesAround(q,b,a)
   def more(a,b,tag,label): return ('<a href="%s?q=%s&a=%d&b=%d#%s" name="%s">%s</a>' % (cginame,quote(undo_alphaOnly_swap(q)),a,b,tag,tag,label)) # 'after' version of this works only if it's at the very bottom of the page, so the words above it are still on-screen when jumping to its hash
   if b < max_show_more and len(b4)==b: moreBefore = more(a,min(b+increment,max_show_more),"b","&lt;&lt; more")+between_before_and_after
   else: moreBefore = '<a name="b"></a>'
@@ -326,10 +703,10 @@ def main(req=None):
   else: moreAfter = '<a name="a"></a>'
   if not '<' in between_before_and_after: tableStyle,tableAround = ' style="display:inline-table"',between_before_and_after
   else: tableStyle,tableAround = "",""
-  out(lnks+moreBefore+"""<script><!--
+  return (moreBefore+"""<script><!--
   function tryInline(l) { l.onclick=function(){return false}; if(!(XMLHttpRequest&&l.innerHTML)) return true; var n=document.createElement("div"); l.parentNode.insertBefore(n,l.nextSibling); n.innerHTML="Loading"; if(n.innerHTML!="Loading") return true; n.setAttribute("style","border:thin blue solid"); function g(h){l.myStuff=h;n.innerHTML=h;if(l.parentNode.nodeName=='TD') l.parentNode.parentNode.parentNode.parentNode.style.display='block';l.onclick=function(){l.parentNode.removeChild(n);if(l.parentNode.nodeName=='TD') l.parentNode.parentNode.parentNode.parentNode.style.display='inline-table';l.onclick=function(){return tryInline(l)};return false};"""+code_to_run_when_DOM_changes+"""}; if(l.myStuff) g(l.myStuff);else{var req=new XMLHttpRequest();req.open("GET",l.href.replace("&e=1","&e=2"),true);req.onreadystatechange=function(){if(req.readyState==4)g(req.responseText)};req.send()}return false }
 //-->
-</script>"""+between_before_and_after.join(link(l) for l in b4)+tableAround+'<table border'+tableStyle+'><tbody><tr><td><a id="e" name="e"></a>'+link(line,q)+'</td></tr></tbody></table>'+tableAround+between_before_and_after.join(link(l) for l in aftr)+moreAfter,req=req)
+</script>"""+between_before_and_after.join(link(l,"",cginame) for l in b4)+tableAround+'<table border'+tableStyle+'><tbody><tr><td><a id="e" name="e"></a>'+link(line,q,cginame)+'</td></tr></tbody></table>'+tableAround+between_before_and_after.join(link(l,"",cginame) for l in aftr)+moreAfter)
 
 def handle(url,req):
     global web_adjuster_extension_url,web_adjuster_extension_url2
@@ -342,4 +719,29 @@ def handle(url,req):
         finally: web_adjuster_extension_url,web_adjuster_extension_url2 = web_adjuster_extension_url2,web_adjuster_extension_url
         return True
 
-if __name__=="__main__": main()
+class WSGIRequest:
+    "The parts of Web Adjuster's request object that main() uses, for application()"
+    def __init__(self,environ):
+        self.request,self.arguments = self,parse_qs(environ.get("QUERY_STRING",""))
+        path = environ.get("SCRIPT_NAME","")+environ.get("PATH_INFO","")
+        self.cginame = path[path.rfind('/')+1:] # for links relative to the page (as the CGI's are)
+        self.headers = dict((k[5:].replace("_","-").title(),v) for k,v in environ.items() if k.startswith("HTTP_")) # (request headers)
+        self.status,self.responseHeaders,self.body = "200 OK",[],[]
+    def set_status(self,code): self.status = {302:"302 Found",304:"304 Not Modified"}.get(code,str(code))
+    def set_header(self,k,v): self.responseHeaders.append((k,v))
+    def write(self,s): self.body.append(B(s))
+def application(environ,start_response):
+    "WSGI application: does what the CGI would, but as html_filename stays loaded (see loaded) it's faster"
+    req = WSGIRequest(environ)
+    main(req)
+    start_response(req.status,req.responseHeaders)
+    return req.body
+def serve(port=8000):
+    "Serves 'application' on port (one request at a time)"
+    from wsgiref.simple_server import make_server
+    sys.stderr.write("Serving on port %d\n" % port)
+    make_server("",port,application).serve_forever()
+
+if __name__=="__main__":
+    if sys.argv[1:2]==["--serve"]: serve(*[int(p) for p in sys.argv[2:3]])
+    else: main()
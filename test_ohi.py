@@ -0,0 +1,150 @@
+import pytest, io, os, re, gzip, json, ohi
+
+words = [w+s for s in u"abcdefghij" for w in [u"zhōng", u"guó", u"-rén", u"hǎo (good)", u"xie, xie", u"lǜ", u"guó"]]
+entries = u''.join(u'<a name="%s"></a><b>%s</b> see <a href="#%s">this</a> %s\n' % (w,w,w,u"x"*(i%7)*50) for i,w in enumerate(words))
+dictionary = entries + u'<a name="end"></a>'
+
+def build(tmp_path,name,**config):
+    d = tmp_path / name ; d.mkdir()
+    ohi.build_index(io.StringIO(dictionary),str(d),**config)
+    return dict((f,(d/f).read_bytes()) for f in os.listdir(str(d)))
+
+def test_build_index(tmp_path):
+    files = build(tmp_path,"out",max_filesize=4096)
+    assert len(files) > 3 and "index.html" in files and "0.html" in files
+    assert b'<a name="z"></a><b>zh\xc5\x8dnga</b>' in b''.join(files.values())
+    assert b'href="index.html#' in files["0.html"]
+    assert all(len(v) < 4096 for k,v in files.items() if not k=="index.html")
+def test_external_sort_is_identical(tmp_path):
+    assert build(tmp_path,"a",max_filesize=4096) == build(tmp_path,"b",max_filesize=4096,sort_memory_budget=1000)
+def test_anchor_reader_chunk_boundaries():
+    s = u'head' + dictionary + u'<a name="x" id="1">foot'
+    parts = re.split(u'<a name="([^"]*)"></a>',s)
+    for chunkSize in [1,2,7,9,64]:
+        r = ohi.AnchorReader(io.StringIO(s),chunkSize)
+        assert list(r) == list(zip(parts[1:-1:2],parts[2:-1:2]))
+        assert r.header == parts[0] and r.footer == parts[-1]
+def test_unknown_option(tmp_path):
+    with pytest.raises(TypeError): build(tmp_path,"out",max_size=4096)
+def test_incremental(tmp_path):
+    files = build(tmp_path,"ref",max_filesize=4096)
+    out = tmp_path / "out" ; out.mkdir()
+    def rebuild(text): return ohi.build_index(io.StringIO(text),str(out),max_filesize=4096,incremental=True)
+    assert sorted(rebuild(dictionary)[0]) == sorted(files)
+    assert all((out/f).read_bytes()==v for f,v in files.items())
+    assert rebuild(dictionary) == ([],[])
+    assert rebuild(dictionary.replace(u"<b>lǜc</b>",u"<b>lǜc</b> edited")) == (["2.html"],[])
+def test_precompress(tmp_path):
+    files = build(tmp_path,"out",max_filesize=4096,precompress=True,max_compressed_filesize=1024)
+    for f in files:
+        if f.endswith(".html"): assert gzip.decompress(files[f+".gz"]) == files[f]
+        if f.endswith(".html.gz") and not f=="index.html.gz": assert len(files[f]) <= 1024
+def test_intermediate_index_pages(tmp_path):
+    files = build(tmp_path,"out",max_filesize=1600)
+    assert "i0.html" in files and len(files["index.html"]) <= 1600
+    assert all(len(v) <= 1600 for k,v in files.items() if k.startswith("i"))
+    assert b'location.replace(' in files["i0.html"]
+@pytest.mark.parametrize("alphabet",[None,u"abcdefghijklmnopqrstuvwxyz"])
+@pytest.mark.parametrize("flags",[(a,b,c) for a in [0,1] for b in [0,1] for c in [0,1]])
+def test_compiled_sort_key(alphabet,flags):
+    reference,alphabet = ohi.composedSortKeyFunction(alphabet,*flags)
+    compiled = ohi.compiledSortKeyFunction(reference,alphabet,*flags)
+    for h in words+[u"@x;;y,, z", u"a~COM~b, c", u"Ǖ (x) - ấ", u"中文 (zh)", u"가ﬁ̸", u"(a)(b); c"]:
+        assert compiled(h) == reference(h)
+def test_bench_stages_match_build_index(tmp_path):
+    import ohi_bench
+    text = ohi_bench.dictionary(300)
+    (tmp_path/"a").mkdir() ; (tmp_path/"b").mkdir()
+    ohi.build_index(io.StringIO(text),str(tmp_path/"a"),max_filesize=8192)
+    stages = ohi_bench.bench_stages(text,str(tmp_path/"b"),max_filesize=8192)
+    assert list(stages) == ["read/split","alphaOnly","sort","ChangedLetters","segmentation","file writing"]
+    assert sorted(os.listdir(str(tmp_path/"a"))) == sorted(os.listdir(str(tmp_path/"b")))
+    for f in os.listdir(str(tmp_path/"a")): assert (tmp_path/"a"/f).read_bytes() == (tmp_path/"b"/f).read_bytes()
+def test_external_js(tmp_path):
+    inline,external = build(tmp_path,"a",max_filesize=2048),build(tmp_path,"b",max_filesize=2048,external_js=True)
+    assert b"function ohi_h(a)" in external["ohi.js"] and b"function inner(" not in external["0.html"]
+    assert all(b'<script src="ohi.js">' in v for k,v in external.items() if k.endswith(".html"))
+    assert all(len(v) < 2048 for k,v in external.items() if not k=="index.html")
+    assert len(external) < len(inline)
+def test_front_coding(tmp_path):
+    assert ohi.frontCodedArray([u"zh",u"zhong",u"zhongguoren",u"zi"]) == [u"0zh",u"2ong",u"5guoren",u"1i"]
+    assert ohi.frontCoded(u"a\U0001f600b",u"a\U0001f600c") == u"3c" # (Javascript counts the surrogate pair as 2)
+    files = build(tmp_path,"out",max_filesize=2048,front_coding=True)
+    assert b"function get(k)" in files["0.html"]
+    assert all(len(v) < 2048 for k,v in files.items() if not k=="index.html")
+@pytest.mark.parametrize("budget,extra",[(None,{}),(1000,{}),(None,{"full_text_search":True})])
+def test_build_profiles(tmp_path,budget,extra):
+    def settings(m): return dict(extra if m==4096 else {},max_filesize=m) # (extra for one profile only)
+    profiles = dict((str(tmp_path/str(m)),settings(m)) for m in [2048,4096,1<<30])
+    for d in profiles: os.mkdir(d)
+    results = ohi.build_profiles(io.StringIO(dictionary),profiles,sort_memory_budget=budget)
+    for m in [2048,4096,1<<30]:
+        d = tmp_path/str(m)
+        assert sorted(results[str(d)][0]) == sorted(os.listdir(str(d)))
+        assert build(tmp_path,"ref%d" % m,**settings(m)) == dict((f,(d/f).read_bytes()) for f in os.listdir(str(d)))
+    with pytest.raises(TypeError): ohi.build_profiles(io.StringIO(dictionary),{str(tmp_path/"x"):{"alphabet":None}})
+def test_build_collection(tmp_path,capsys):
+    half = entries.index(u'<a name="%s">' % words[35])
+    (tmp_path/"a.html").write_text(u"<html><body>Header"+entries[:half]+u'<a name="end"></a>Footer</body></html>',encoding="utf-8")
+    (tmp_path/"b.html").write_text(entries[half:]+u'<a name="end"></a>',encoding="utf-8")
+    expected = tmp_path/"expected" ; expected.mkdir() ; out = tmp_path/"out" ; out.mkdir()
+    ohi.build_index(io.StringIO(u"<html><body>Header"+entries+u'<a name="end"></a>Footer</body></html>'),str(expected),max_filesize=4096)
+    def collect(): return ohi.build_collection([str(tmp_path/"a.html"),str(tmp_path/"b.html")],str(out),max_filesize=4096)
+    collect()
+    assert sorted(os.listdir(str(out))) == sorted(os.listdir(str(expected)))
+    assert all((out/f).read_bytes()==(expected/f).read_bytes() for f in os.listdir(str(out)))
+    capsys.readouterr()
+    (tmp_path/"b.html").write_text(entries[half:]+u'<a name="x"></a>extra<a name="end"></a>',encoding="utf-8")
+    collect()
+    assert capsys.readouterr().err.count("Sorting") == 1
+def test_full_text_search(tmp_path):
+    files = build(tmp_path,"out",max_filesize=1024,full_text_search=True)
+    assert b'href="search.html"' in files["index.html"] and b"function search()" in files["search.html"]
+    shards = [f for f in files if re.match(r"s[0-9]+\.js$",f)]
+    assert len(shards) > 1 and all(len(files[f]) <= 1024 for f in shards)
+    found = {}
+    for f in shards:
+        assert files[f].startswith(b"ohi_s(") and files[f].endswith(b")\n")
+        for w,t in json.loads(files[f][6:-2].decode("utf-8")).items(): found.setdefault(w,[]).extend(t)
+    assert sorted(found["good"]) == sorted(set(found["good"])) and len(found["good"]) == 10
+    assert all(t.split("#")[0]+".html" in files for t in found["xie"])
+    assert ohi.searchWords(u"<b>Zhōng</b>guó &amp; 中国人") == set([u"zhong",u"guo",u"中",u"国",u"人",u"中国",u"国人"])
+    assert ohi.searchWords(u"hello，world “quoted”") == set([u"hello",u"world",u"quoted"]) # (split on non-ASCII punctuation as search.html does)
+    assert u"[\\u3400-\\u9fff\\uf900-\\ufaff]+" in files["search.html"].decode("utf-8")
+def test_zero_copy_is_identical(tmp_path):
+    assert build(tmp_path,"a",max_filesize=4096) == build(tmp_path,"b",max_filesize=4096,zero_copy=True)
+    (tmp_path/"in.html").write_text(dictionary,encoding="utf-8") ; (tmp_path/"c").mkdir()
+    ohi.build_index(str(tmp_path/"in.html"),str(tmp_path/"c"),max_filesize=4096,zero_copy=True)
+    assert all((tmp_path/"a"/f).read_bytes()==(tmp_path/"c"/f).read_bytes() for f in os.listdir(str(tmp_path/"a")))
+def test_hashed_names(tmp_path):
+    plain,files = build(tmp_path,"a",max_filesize=2048),build(tmp_path,"b",max_filesize=2048,hashed_names=True)
+    pages = sorted(f for f in files if re.match(r"[0-9a-f]{12}\.html$",f))
+    assert len(pages) == len([f for f in plain if re.match(r"[0-9]+\.html$",f)]) > 1
+    assert all(len(files[f]) < 2048 for f in pages)
+    assert all(f[:-5].encode() in files["index.html"] for f in pages)
+    out = tmp_path / "out" ; out.mkdir()
+    def rebuild(text): return ohi.build_index(io.StringIO(text),str(out),max_filesize=2048,incremental=True,hashed_names=True)
+    assert sorted(rebuild(dictionary)[0]) == sorted(files) and rebuild(dictionary) == ([],[])
+    order = [p["name"] for p in json.load(open(str(out/ohi.manifestFile)))["pages"]]
+    firstKeys = [re.search(u'<a name="([^_"][^"]*)"',files[n+".html"].decode("utf-8")).group(1) for n in order]
+    alphabet = ohi.Build({}).alphabet
+    def jump(val): # as index.html does with a hash
+        val = re.sub(u"(\\+|%20)",u" ",val).replace(u"-",u" ").replace(u",",u"~COM~").replace(u";",u",").replace(u"~COM~",u";").replace(u" ",u";")
+        return u"".join(c for c in re.sub(u"([;,]);+",u"\\1",val).lower() if c in alphabet)
+    resolved = 0
+    for i,n in enumerate(order): # page links go via index.html to an entry on the page either side, so they don't depend on names
+        for h,x in re.findall(u'<a name="_([hf])" href="index.html#([^"]*)"',files[n+".html"].decode("utf-8")):
+            val = jump(x) ; page = max(j for j,k in enumerate(firstKeys) if k <= val)
+            assert page == i+{u"h":-1,u"f":1}[h] and u'<a name="'+val+u'"' in files[order[page]+".html"].decode("utf-8")
+            resolved += 1
+    assert resolved == 2*len(order)-2
+    written,removed = rebuild(dictionary.replace(u"<b>lǜc</b>",u"<b>lǜc</b> edited"))
+    assert len(removed) == 1 and removed[0] in pages and not removed[0] in written and len(written) == 2 and "index.html" in written # (the neighbours' links are unchanged)
+def test_ingest_processes(tmp_path):
+    (tmp_path/"in.html").write_text(u"header"+dictionary+u"footer",encoding="utf-8")
+    B = ohi.Build({}) ; serial = ohi.MappedInput(str(tmp_path/"in.html"))
+    keyed = serial.keyed(B.alphaOnly)
+    for processes in [2,3,100]:
+        m = ohi.MappedInput(str(tmp_path/"in.html"))
+        assert (m.keyed(B.alphaOnly,processes),m.header,m.footer) == (keyed,u"header",serial.footer)
+    assert build(tmp_path,"a",max_filesize=4096) == build(tmp_path,"b",max_filesize=4096,zero_copy=True,ingest_processes=0)
@@ -0,0 +1,144 @@
+import pytest, os, zlib, threading, ohi_online
+ohi_online_entries = ohi_online.entries
+
+def request(query,path="/dict/ohi",**headers):
+    status,headers,body = request_bytes(query,path,**headers)
+    return status,headers,body.decode("utf-8")
+
+def request_bytes(query,path="/dict/ohi",**headers):
+    got = {} ; environ = {"QUERY_STRING":query,"SCRIPT_NAME":path}
+    environ.update(("HTTP_"+k.upper(),v) for k,v in headers.items())
+    def start_response(status,headers): got["status"],got["headers"] = status,dict(headers)
+    body = b"".join(ohi_online.application(environ,start_response))
+    return got["status"],got["headers"],body
+
+@pytest.fixture
+def dictionary(tmp_path,monkeypatch):
+    f = tmp_path / "input.html"
+    f.write_text(u'<html><body><a name="zhōng"></a>middle <a href="#guó">see</a>\n<a name="guó"></a>country\n<a name="rén"></a>person\n<a name=""></a></body></html>',encoding="utf-8")
+    monkeypatch.setattr(ohi_online,"html_filename",str(f))
+    return f
+
+def test_wsgi(dictionary):
+    status,headers,body = request("q=guo")
+    assert status.startswith("302") and headers["Location"]=="ohi?q=guo&t=1#e"
+    status,headers,body = request("q=guo&t=1")
+    assert status=="200 OK" and headers["Content-type"].startswith("text/html") and '<form action="ohi">' in body
+    assert '<a href="ohi?q=guo&e=1" onclick="return tryInline(this)"><b>gu</b>ó</a>' in body
+    assert request("q=zhong&e=2")[2]==u'middle <a href="ohi?e=1&q=guó">see</a>\n'
+    assert "<form" in request("",path="/")[2]
+
+def test_reload(dictionary):
+    assert request("q=ren&e=2")[2]==u"person\n"
+    index = ohi_online.loadedFiles[str(dictionary)][1][1]
+    assert request("q=ren&e=2")[2]==u"person\n" and ohi_online.loadedFiles[str(dictionary)][1][1] is index
+    dictionary.write_text(dictionary.read_text(encoding="utf-8").replace("person","people"),encoding="utf-8")
+    mtime = os.stat(str(dictionary)).st_mtime+10 ; os.utime(str(dictionary),(mtime,mtime))
+    assert request("q=ren&e=2")[2]==u"people\n"
+
+def test_line_offsets(dictionary):
+    request("q=ren&e=2")
+    lines = open(str(dictionary)+".lines","rb").read()
+    index = open(str(dictionary)+".index","rb").read()
+    assert len(lines)==8*4 and [ohi_online.struct.unpack_from("<Q",lines,8*i)[0] for i in range(4)]==[0]+[i+1 for i,c in enumerate(index) if c==10]
+    os.remove(str(dictionary)+".lines") ; ohi_online.loadedFiles.clear() # as if .index was from a version without .lines
+    assert request("q=guo&e=2")[2]==u"country\n" and os.path.exists(str(dictionary)+".lines")
+    index = ohi_online.loadedFiles[str(dictionary)][1][1]
+    assert [index.bisect(q) for q in ["","guo","gup","ren","zhong","zzz"]] == [0,0,0,1,2,3] # ("gup" is nearer "guo" than "ren")
+
+def test_binary_index(dictionary,monkeypatch):
+    queries = ["q=guo&t=1","q=zh&t=1&a=1&b=0","q=zhong&e=2","q=zzz&t=1","q=a&e=2"]
+    text = [request(q)[::2] for q in queries]
+    monkeypatch.setattr(ohi_online,"binary_index",True) ; ohi_online.loadedFiles.clear()
+    assert [request(q)[::2] for q in queries] == text
+    index = ohi_online.loadedFiles[str(dictionary)][1][1]
+    assert isinstance(index,ohi_online.BinaryIndex) and index.n==3
+    assert index.entry(2)==(u"zhong",u"zhōng",[(33,64)]) and index.entry(3)==(u"",u"",[])
+
+@pytest.mark.skipif(not ohi_online.fcntl,reason="needs fcntl")
+def test_single_flight(dictionary):
+    import subprocess, sys, time
+    def child(query): return subprocess.Popen([sys.executable,"-c","import ohi_online,sys ; ohi_online.html_filename=sys.argv[1] ; sys.stdout.buffer.write(b''.join(ohi_online.application({'QUERY_STRING':sys.argv[2]},lambda s,h:None)))",str(dictionary),query],stdout=subprocess.PIPE,cwd=os.path.dirname(os.path.abspath(ohi_online.__file__)))
+    def edit(old,new):
+        dictionary.write_text(dictionary.read_text(encoding="utf-8").replace(old,new),encoding="utf-8")
+        mtime = os.stat(str(dictionary)).st_mtime+10 ; os.utime(str(dictionary),(mtime,mtime))
+        return mtime
+    request("q=ren&e=2")
+    lock = ohi_online.IndexLock(str(dictionary)) ; lock.lock(lock.updating,True) # as if another process is updating
+    edit(u"</html>",u"</html>\n<!-- appended -->")
+    assert child("q=ren&e=2").communicate()[0]==b"person\n" # the old index, not waiting
+    mtime = edit(u'<a name="zhōng">',u'<a name="ài"></a>love\n<a name="zhōng">') # moves the entries, so the old index won't do
+    p = child("q=ren&e=2") ; time.sleep(1)
+    assert p.poll() is None # (waiting)
+    lock.unlock(lock.updating)
+    assert p.communicate()[0]==b"person\n" and os.stat(str(dictionary)+".index").st_mtime==mtime
+    assert not [f for f in os.listdir(str(dictionary.parent)) if ".new" in f]
+
+def test_incremental_update(dictionary,monkeypatch):
+    monkeypatch.setattr(ohi_online,"index_block_size",20)
+    text = dictionary.read_text(encoding="utf-8") ; request("q=ren&e=2")
+    assert len(ohi_online.json.load(open(str(dictionary)+".blocks"))["blocks"]) == 4
+    scanned = []
+    monkeypatch.setattr(ohi_online,"entries",lambda txt,start=0,end=None:scanned.append((start,end)) or ohi_online_entries(txt,start,end))
+    for edit,start in [(text.replace(u"person",u"people"),64),(text.replace(u"country",u"land").replace(u"<a name=\"\">",u"<a name=\"rén\"></a>again\n<a name=\"\">"),0)]:
+        dictionary.write_text(edit,encoding="utf-8")
+        mtime = os.stat(str(dictionary)).st_mtime+10 ; os.utime(str(dictionary),(mtime,mtime))
+        del scanned[:] ; request("q=ren&e=2")
+        assert scanned==[(start,None)] # (from the block before the change)
+        txt = ohi_online.create_linemap(str(dictionary))
+        assert open(str(dictionary)+".index").read() == ohi_online.scan(txt)[0]
+    assert request("q=ren&e=2")[2]==u"person\n<hr>again\n"
+
+def test_conditional_requests_and_cache(dictionary,monkeypatch):
+    status,headers,body = request("q=guo&t=1")
+    etag,lastModified = headers["ETag"],headers["Last-Modified"]
+    assert request("q=guo&t=1",if_none_match=etag)[::2] == ("304 Not Modified",u"")
+    assert request("q=guo&e=2",if_none_match='"x", '+etag)[0] == "304 Not Modified"
+    assert request("q=guo&t=1",if_none_match='"x"',if_modified_since=lastModified)[0] == "200 OK" # (If-None-Match wins)
+    assert request("q=guo&t=1",if_modified_since=lastModified)[0] == "304 Not Modified"
+    assert request("q=guo&t=1",if_modified_since="Thu, 01 Jan 1970 00:00:00 GMT")[0] == "200 OK"
+    rendered = []
+    monkeypatch.setattr(ohi_online,"render",lambda *args:rendered.append(args[2:6]) or u"x")
+    assert request("q=guo&t=1")[2] == body and request("q=gu%C3%B3&t=1")[2] == body and not rendered # (same key after alphaOnly)
+    dictionary.write_text(dictionary.read_text(encoding="utf-8").replace(u"country",u"land"),encoding="utf-8")
+    mtime = os.stat(str(dictionary)).st_mtime+10 ; os.utime(str(dictionary),(mtime,mtime))
+    status,headers,body = request("q=guo&t=1",if_none_match=etag)
+    assert status == "200 OK" and headers["ETag"] != etag and rendered == [(u"guo",10,5,u"")]
+
+def test_gemini(dictionary,monkeypatch,capsys):
+    monkeypatch.setattr(ohi_online,"gemini_mode",True)
+    monkeypatch.setenv("QUERY_STRING","q=guo&e=1")
+    monkeypatch.setenv("HTTP_IF_NONE_MATCH","*")
+    ohi_online.main()
+    got = capsys.readouterr().out
+    assert got.startswith("20 text/gemini") and "country" in got
+
+def test_compression(dictionary,monkeypatch):
+    status,headers,body = request("q=guo&t=1")
+    assert "Content-Encoding" not in headers and headers["Vary"] == "Accept-Encoding"
+    def compressed(query,accept,wbits):
+        status,headers,raw = request_bytes(query,accept_encoding=accept)
+        return headers["Content-Encoding"],headers["ETag"],zlib.decompress(raw,wbits).decode("utf-8")
+    encoding,etag,gzipped = compressed("q=guo&t=1","deflate;q=0.5, gzip",16+zlib.MAX_WBITS)
+    assert encoding == "gzip" and gzipped == body and etag != headers["ETag"]
+    assert compressed("q=guo&t=1","gzip;q=0, deflate",zlib.MAX_WBITS)[::2] == ("deflate",body)
+    assert "Content-Encoding" not in request("q=guo&t=1",accept_encoding="gzip;q=0, identity")[1]
+    monkeypatch.setattr(ohi_online,"stream_expansions_over",0)
+    monkeypatch.setattr(ohi_online,"render",None) # streamed expansions don't go through render
+    assert compressed("q=zhong&e=2","gzip",16+zlib.MAX_WBITS)[2] == u'middle <a href="ohi?e=1&q=guó">see</a>\n'
+    assert u"person" in request("q=ren&e=1")[2]
+    monkeypatch.setattr(ohi_online,"preprocess_result",lambda markup:markup.upper())
+    assert request("q=ren&e=2")[2] == u"PERSON\n" # (streamed expansions are still preprocessed, an entry at a time)
+
+def test_concurrent_requests(dictionary):
+    request("q=guo&t=1") # (load it first)
+    wrong = []
+    def lookups(name,accept):
+        for i in range(20):
+            status,headers,body = request_bytes("q=guo&t=%d" % (i+1),"/dict/"+name,accept_encoding=accept)
+            if accept: body = zlib.decompress(body,16+zlib.MAX_WBITS)
+            if headers.get("Content-Encoding",accept)!=accept or headers["ETag"].endswith('-gzip"')!=bool(accept) or not b'<form action="'+name.encode()+b'">' in body: wrong.append(name)
+    threads = [threading.Thread(target=lookups,args=("ohi%d" % i,["","gzip"][i%2])) for i in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert not wrong